@@ -0,0 +1,248 @@
+import csv
+import html
+import json
+import random
+import logging
+from datetime import date, datetime
+from itertools import product
+from string import ascii_uppercase
+import openpyxl
+from openpyxl.styles import Protection
+from topline import MONTHS
+from topline.excel import header_row, user_row, roi_row, member_row, last_expense_row
+
+logger = logging.getLogger(__name__)
+
+CHEQUE_ACCOUNT = 62000000001
+SAVINGS_ACCOUNT = 62000000002
+ACCOUNTS = [(CHEQUE_ACCOUNT, 'Gold Cheque'), (SAVINGS_ACCOUNT, 'Savings Pocket')]
+
+# contribution rows available on a v7 tracking sheet, including the TIG row
+V7_MEMBERS = roi_row - user_row
+
+
+def get_usernames(members):
+    """Returns a list of members synthetic usernames.
+
+    Usernames are Q followed by three letters, so they never clash with month
+    names or words in transaction descriptions. Up to 17576 are available.
+    """
+    names = (''.join(('Q',) + letters) for letters in product(ascii_uppercase, repeat=3))
+    return [name for name, _ in zip(names, range(members))]
+
+
+def make_users(members, seed=1):
+    """Returns a users dict in the format of the users json file read by DB.initialise_users.
+
+    TIG is always included. About one in ten members has an alternative username.
+    """
+    rng = random.Random(seed)
+    users = {'TIG': {'firstName': 'Topline', 'lastName': 'Investment Group', 'email': 'tig@example.com'}}
+    for username in get_usernames(members):
+        users[username] = {'firstName': username.capitalize(), 'lastName': 'Member',
+                           'email': '{}@example.com'.format(username.lower())}
+        if rng.random() < 0.1:
+            users[username]['alt_id'] = username + 'X'
+    return users
+
+
+def write_users(filename, members, seed=1):
+    with open(filename, 'w') as f:
+        json.dump(make_users(members, seed), f, indent=2)
+    logger.info("Wrote %s users to %s", members + 1, filename)
+
+
+def make_transactions(usernames, years, seed=1):
+    """Returns synthetic (transaction, account) pairs, oldest first.
+
+    Each year from March to February, every member pays a monthly
+    contribution into the cheque account with a reference like
+    'QABC - MAR17', using an alternative or misspelt reference now and then.
+    The cheque account also has a monthly fee and occasional income and
+    expenses. The savings account gets a monthly profit share.
+
+    Transactions are tuples in the format returned by FNB.get_transactions.
+    """
+    rng = random.Random(seed)
+    pairs = []
+    for year in years:
+        for month in list(range(3, 13)) + [1, 2]:
+            y = year if month >= 3 else year + 1
+            for username in usernames:
+                if rng.random() < 0.05:
+                    continue
+                d = date(y, month, rng.randint(1, 28))
+                ref = '{} - {}{:02d}'.format(username, MONTHS[month][-1], y % 100)
+                if rng.random() < 0.02:
+                    ref = '{} {} {}'.format(username.lower(), MONTHS[month][0].lower(), y)
+                amount = rng.choice([250, 500, 1000, 1500])
+                pairs.append(((d, 'FNB APP PAYMENT FROM ' + username, ref, amount), CHEQUE_ACCOUNT))
+            last_day = date(y, month, 28)
+            pairs.append(((last_day, 'MONTHLY ACCOUNT FEE', '', -65.0), CHEQUE_ACCOUNT))
+            pairs.append(((last_day, 'PROFIT SHARE', '', round(rng.uniform(50, 500), 2)), SAVINGS_ACCOUNT))
+            if rng.random() < 0.2:
+                pairs.append(((date(y, month, 15), 'INTERNET PMT TO AUDITOR', 'FEES', -350.0), CHEQUE_ACCOUNT))
+            if rng.random() < 0.1:
+                pairs.append(((date(y, month, 10), 'DEPOSIT', 'DIVIDEND', 420.0), CHEQUE_ACCOUNT))
+    pairs.sort(key=lambda p: p[0][0])
+    return [((d.strftime('%d %b %Y'), desc, ref, '', '{:.2f}'.format(amount), ''), account)
+            for (d, desc, ref, amount), account in pairs]
+
+
+def write_statement(filename, usernames, years, account=CHEQUE_ACCOUNT, seed=1):
+    """Writes the transactions of one account to an FNB style CSV statement readable by read_statement."""
+    count = 0
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Account Number', account])
+        writer.writerow(['Date', 'Amount', 'Balance', 'Description', 'Reference'])
+        balance = 0.0
+        for transaction, acc in make_transactions(usernames, years, seed):
+            if acc != account:
+                continue
+            balance += float(transaction[4])
+            d = datetime.strptime(transaction[0], '%d %b %Y').strftime('%Y/%m/%d')
+            writer.writerow([d, transaction[4], '{:.2f}'.format(balance), transaction[1], transaction[2]])
+            count += 1
+    logger.info("Wrote %s transactions to %s", count, filename)
+    return count
+
+
+# pages of the static FNB site. Only the elements FNB reads, clicks or waits on are included
+FNB_PAGE = """<!DOCTYPE html>
+<html id="zaSkin">
+<head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<div id="loaderOverlay" data-visible="false"></div>
+{menu}
+{content}
+</body>
+</html>
+"""
+FNB_MENU = """<a id="menuBtn" href="#">Menu</a>
+<div id="menu"><a class="iconButton" href="accounts.html">My Bank Accounts</a></div>"""
+FNB_LOGIN = """<form action="landing.html" method="get">
+<input id="user" name="user"><input id="pass" name="pass" type="password">
+<input id="OBSubmit" type="submit" value="Login">
+</form>"""
+FNB_LANDING = """<div id="newsLanding"><div></div><div></div><div><ul><li><div>Welcome</div></li></ul></div></div>"""
+FNB_ACCOUNT_ROW = """<div class="tableRow"><a id="nickname{index}" href="account_{acc_num}.html">{name}</a>
+<span id="accountNumber{index}">{acc_num}</span><span id="ledgerBalance{index}">R{balance:,.2f}</span></div>"""
+FNB_TRANSACTION_ROW = """<div class="tableRow"><div id="counter">{}</div><div id="shortDescription">{}</div>
+<div id="reference">{}</div><div id="serviceFee">{}</div><div id="amount">{}</div><div id="ledgerBalance">{}</div></div>"""
+
+
+def write_fnb_page(filename, title, content, menu=True):
+    with open(filename, 'w') as f:
+        f.write(FNB_PAGE.format(title=title, menu=FNB_MENU if menu else '', content=content))
+
+
+def write_fnb_site(folder, usernames, years, seed=1, limit=None, accounts=ACCOUNTS):
+    """Writes a static copy of the FNB online banking pages read by topline.scraper.FNB.
+
+    The site has a login page, a landing page, the accounts page and a
+    transaction history page for each account, linked to each
+    other with relative links so it can be opened from file:// or served
+    with http.server. Any username and password log in.
+
+    Args:
+        folder: pathlib.Path of the folder to write the pages to.
+        usernames: Member usernames, as returned by get_usernames.
+        years: Years of history, as for make_transactions.
+        seed: Optional. Seed for make_transactions.
+        limit: Optional. Number of most recent transactions listed for each account.
+        accounts: Optional. List of (account number, name) of the accounts.
+            Accounts after the first two get the transactions of the first
+            two generated with other seeds.
+
+    Returns:
+        A dict of account number to the entry FNB.get_accounts should read
+        for it, with the name, nickname, balance and the transactions as
+        returned by FNB.get_transactions, newest first.
+    """
+    site = {}
+    for i, (acc_num, name) in enumerate(accounts):
+        account = {'name': name, 'nickname': 'nickname{}'.format(i), 'balance': 0.0, 'transactions': []}
+        source = ACCOUNTS[i % len(ACCOUNTS)][0]
+        for (d, desc, ref, fee, amount, _), acc in make_transactions(usernames, years, seed + i // len(ACCOUNTS)):
+            if acc == source:
+                account['balance'] = round(account['balance'] + float(amount), 2)
+                account['transactions'].append((d, desc, ref, fee, amount, '{:.2f}'.format(account['balance'])))
+        account['transactions'] = account['transactions'][::-1][:limit]
+        # FNB.get_accounts reads the balance without its sign
+        account['balance'] = abs(account['balance'])
+        site[acc_num] = account
+
+    write_fnb_page(folder.joinpath('login.html'), 'Login', FNB_LOGIN, menu=False)
+    write_fnb_page(folder.joinpath('landing.html'), 'Home', FNB_LANDING)
+    rows = [FNB_ACCOUNT_ROW.format(index=i, acc_num=acc_num, name=html.escape(account['name']),
+                                   balance=account['balance'])
+            for i, (acc_num, account) in enumerate(site.items())]
+    write_fnb_page(folder.joinpath('accounts.html'), 'My Bank Accounts',
+                   '<div id="extendedPageHeader">My Bank Accounts</div>\n'
+                   '<div id="accountsTable_tableContent">\n{}\n</div>'.format('\n'.join(rows)))
+    for acc_num, account in site.items():
+        rows = [FNB_TRANSACTION_ROW.format(*(html.escape(value) for value in t)) for t in account['transactions']]
+        write_fnb_page(folder.joinpath('account_{}.html'.format(acc_num)), account['name'],
+                       '<div id="subTabsScrollable"><a class="subTabText" href="#">Details</a>'
+                       '<a class="subTabText" href="#">Transaction History</a></div>\n'
+                       '<div id="transactionHistoryTables_tableContent">\n{}\n</div>'.format('\n'.join(rows)))
+    logger.info("Wrote FNB site with %s accounts to %s", len(site), folder)
+    return site
+
+
+def write_workbook(filename, usernames, years):
+    """Writes an empty tracking workbook in the v7 layout.
+
+    Has a summary sheet listing TIG and the members, and one sheet per year
+    from March to February with unlocked data rows. The v7 layout has room
+    for V7_MEMBERS rows of contributions, so only the first members are
+    added.
+    """
+    if len(usernames) + 1 > V7_MEMBERS:
+        logger.warning("v7 tracking sheets hold %s members. Using the first %s of %s",
+                       V7_MEMBERS - 1, V7_MEMBERS - 1, len(usernames))
+        usernames = usernames[:V7_MEMBERS - 1]
+    workbook = openpyxl.Workbook()
+    summary = workbook.active
+    summary.title = 'Summary'
+    for row, username in enumerate(['TIG'] + usernames, 5):
+        summary.cell(row=row, column=2).value = username
+    # Excel.get_user_ids reads up to the last used row of the sheet
+    summary.cell(row=100, column=1).value = 'End'
+    for year in years:
+        sheet = workbook.create_sheet('MAR {:02d} - FEB {:02d}'.format(year % 100, (year + 1) % 100))
+        for col, month in enumerate(list(range(3, 13)) + [1, 2], 2):
+            sheet.cell(row=header_row, column=col).value = datetime(year if month >= 3 else year + 1, month, 1)
+        for row in range(member_row, last_expense_row + 1):
+            for col in range(1, 14):
+                sheet.cell(row=row, column=col).protection = Protection(locked=False)
+    workbook.save(filename)
+    logger.info("Wrote workbook for %s members and %s years to %s", len(usernames), len(years), filename)
+    return usernames
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(description='Generate synthetic users, statements and tracking workbooks')
+    parser.add_argument('folder', help='folder to write the files to')
+    parser.add_argument('--members', type=int, default=30, help='number of members')
+    parser.add_argument('--years', type=int, default=5, help='years of history')
+    parser.add_argument('--first-year', type=int, default=2014, help='first year of history')
+    parser.add_argument('--fnb-site', action='store_true', help='also write a static FNB site to <folder>/fnb')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(module)-12s %(levelname)-8s %(message)s')
+
+    folder = Path(args.folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    history = list(range(args.first_year, args.first_year + args.years))
+    names = get_usernames(args.members)
+    write_users(folder.joinpath('users.json'), args.members)
+    for acc_num, _ in ACCOUNTS:
+        write_statement(folder.joinpath('statement_{}.csv'.format(acc_num)), names, history, acc_num)
+    write_workbook(folder.joinpath('tracking.xlsx'), names, history)
+    if args.fnb_site:
+        folder.joinpath('fnb').mkdir(exist_ok=True)
+        write_fnb_site(folder.joinpath('fnb'), names, history)
@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from topline.db import DB
+from topline.excel import Excel
+from topline.gmail import Gmail
+from topline.scraper import FNB
+from topline.transaction import Transaction
+from benchmarks.generate import ACCOUNTS, CHEQUE_ACCOUNT, get_usernames, make_transactions, write_users, \
+    write_statement, write_workbook, write_fnb_site
+
+logger = logging.getLogger(__name__)
+
+BASELINE = Path(__file__).with_name('baseline.json')
+
+# browser used by the scraper benchmark. TOPLINE_DRIVER_PATH is the path to chromedriver when using chrome
+DRIVER = os.environ.get('TOPLINE_DRIVER', 'firefox')
+DRIVER_PATH = os.environ.get('TOPLINE_DRIVER_PATH')
+
+
+def best_of(func, repeat, setup=None):
+    # return the fastest of repeat runs of func in seconds, calling setup untimed before each run
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = perf_counter()
+        func(*args)
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def result(seconds, items):
+    return {'seconds': round(seconds, 6), 'items': items, 'us_per_item': round(seconds / items * 1e6, 3)}
+
+
+def peak_memory(func):
+    # return the peak bytes allocated by Python while running func
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def set_users(usernames):
+    # set the users and accounts used by Transaction, in the format returned by the database
+    Transaction.usernames = [(i, name, None) for i, name in enumerate(['TIG'] + usernames, 1)]
+    Transaction.accounts = [(acc_num, name, 0.0, 1) for acc_num, name in ACCOUNTS]
+
+
+def create_db(folder, members):
+    # create a database with members users and the benchmark accounts
+    write_users(folder.joinpath('users.json'), members)
+    db = DB(str(folder.joinpath('topline.db')), str(folder.joinpath('users.json')))
+    for acc_num, name in ACCOUNTS:
+        db.add_account(acc_num, name, 0.0)
+    return db
+
+
+def bench_process_transaction(members, years, repeat, limit=20000):
+    """Transaction.process_transaction for growing numbers of members."""
+    results = {}
+    for count in members:
+        usernames = get_usernames(count)
+        set_users(usernames)
+        pairs = make_transactions(usernames, years)[:limit]
+
+        def process():
+            for trans, account in pairs:
+                Transaction(trans, account).process_transaction()
+        results['process_transaction[members={}]'.format(count)] = result(best_of(process, repeat), len(pairs))
+    return results
+
+
+def bench_db_ingest(members, years, repeat):
+    """DB.ingest_transactions and DB.import_statement of the full history into a new database."""
+    results = {}
+    for count in members:
+        usernames = get_usernames(count)
+        pairs = make_transactions(usernames, years)
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = Path(tmp)
+            statement = folder.joinpath('statement.csv')
+            write_statement(statement, usernames, years)
+            items = sum(1 for _, account in pairs if account == ACCOUNTS[0][0])
+
+            def setup():
+                folder.joinpath('topline.db').unlink(missing_ok=True)
+                db = create_db(folder, count)
+                Transaction.usernames = db.get_usernames()
+                Transaction.accounts = db.get_accounts()
+                return db, [Transaction(trans, account) for trans, account in pairs]
+
+            def ingest(db, transactions):
+                db.ingest_transactions(transactions)
+                db.close_db()
+
+            def import_statement(db, _):
+                db.import_statement(str(statement))
+                db.close_db()
+
+            results['db_ingest[members={}]'.format(count)] = result(best_of(ingest, repeat, setup), len(pairs))
+            results['db_import_statement[members={}]'.format(count)] = result(
+                best_of(import_statement, repeat, setup), items)
+    return results
+
+
+def bench_excel(members, years, repeat):
+    """Excel.add_transaction for the full history followed by close_workbook."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        template = folder.joinpath('template.xlsx')
+        usernames = write_workbook(template, get_usernames(max(members)), years)
+        set_users(usernames)
+        transactions = [Transaction(trans, account) for trans, account in make_transactions(usernames, years)]
+        for t in transactions:
+            t.process_transaction()
+        transactions = [t for t in transactions if t.type != 'unknown']
+        times = {'add': [], 'close': []}
+        for _ in range(repeat):
+            workbook = folder.joinpath('tracking.xlsx')
+            shutil.copy(template, workbook)
+            Excel.user_ids = None
+            excel = Excel(str(workbook))
+            start = perf_counter()
+            for t in transactions:
+                excel.add_transaction(t)
+            times['add'].append(perf_counter() - start)
+            start = perf_counter()
+            excel.close_workbook()
+            times['close'].append(perf_counter() - start)
+        Excel.user_ids = None
+        key = 'members={},years={}'.format(len(usernames), len(years))
+        results['excel_add_transaction[{}]'.format(key)] = result(min(times['add']), len(transactions))
+        results['excel_close_workbook[{}]'.format(key)] = result(min(times['close']), len(transactions))
+    return results
+
+
+def bench_create_message(members, years, repeat, messages=100):
+    """Gmail.create_message with the tracking workbook attached, with and without a cached attachment.
+
+    Also records the peak bytes allocated to create one message, as peak_bytes.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workbook = Path(tmp).joinpath('tracking.xlsx')
+        write_workbook(workbook, get_usernames(max(members)), years)
+        text = 'Dear Member,\n\nPlease find attached the tracking sheet.\n' * 5
+
+        def create(cached, count=messages):
+            for i in range(count):
+                if not cached:
+                    Gmail.attachment_cache.clear()
+                Gmail.create_message('member{}@example.com'.format(i), 'Tracking', text, str(workbook))
+        results['gmail_create_message[uncached]'] = dict(result(best_of(lambda: create(False), repeat), messages),
+                                                         peak_bytes=peak_memory(lambda: create(False, 1)))
+        create(True)
+        results['gmail_create_message[cached]'] = dict(result(best_of(lambda: create(True), repeat), messages),
+                                                       peak_bytes=peak_memory(lambda: create(True, 1)))
+        Gmail.attachment_cache.clear()
+    return results
+
+
+def bench_extract_columns(members, years, repeat, rows=300):
+    """FNB.extract_columns of a transaction history page from the static FNB site, with and without a script."""
+    results = {}
+    fnb = FNB(DRIVER, headless=True, driver_path=DRIVER_PATH)
+    if not fnb.driver:
+        logger.warning("No %s browser available. Skipping the extract_columns benchmark", DRIVER)
+        return results
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = Path(tmp)
+            accounts = write_fnb_site(folder, get_usernames(max(members)), years, limit=rows)
+            fnb.driver.get(folder.joinpath('account_{}.html'.format(CHEQUE_ACCOUNT)).as_uri())
+            items = len(accounts[CHEQUE_ACCOUNT]['transactions'])
+            for mode, script in (('script', True), ('elements', False)):
+                fnb.script_extraction = script
+                seconds = best_of(lambda: fnb.extract_columns(FNB.transaction_xpaths), repeat)
+                results['fnb_extract_columns[{},rows={}]'.format(mode, items)] = result(seconds, items)
+    finally:
+        fnb.driver.quit()
+    return results
+
+
+BENCHMARKS = {
+    'process_transaction': bench_process_transaction,
+    'db_ingest': bench_db_ingest,
+    'excel': bench_excel,
+    'create_message': bench_create_message,
+    'extract_columns': bench_extract_columns,
+}
+
+
+def compare(results, baseline, threshold):
+    # print each result next to its baseline, marking results slower or using more memory than the baseline by
+    # more than threshold
+    print('{:<50} {:>12} {:>12} {:>8}'.format('benchmark', 'us/item', 'baseline', 'ratio'))
+    regressions = 0
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base:
+            ratio = r['us_per_item'] / base['us_per_item']
+            flag = ' SLOWER' if ratio > 1 + threshold else ''
+            regressions += bool(flag)
+            print('{:<50} {:>12.2f} {:>12.2f} {:>7.2f}x{}'.format(name, r['us_per_item'], base['us_per_item'],
+                                                                  ratio, flag))
+        else:
+            print('{:<50} {:>12.2f} {:>12} {:>8}'.format(name, r['us_per_item'], '-', '-'))
+        if 'peak_bytes' in r:
+            base_peak = base.get('peak_bytes') if base else None
+            if base_peak:
+                ratio = r['peak_bytes'] / base_peak
+                flag = ' MORE MEMORY' if ratio > 1 + threshold else ''
+                regressions += bool(flag)
+                print('{:<50} {:>12.1f} {:>12.1f} {:>7.2f}x{}'.format('  peak KiB', r['peak_bytes'] / 1024,
+                                                                      base_peak / 1024, ratio, flag))
+            else:
+                print('{:<50} {:>12.1f} {:>12} {:>8}'.format('  peak KiB', r['peak_bytes'] / 1024, '-', '-'))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the contribution tracker benchmarks')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run, all if none given: {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000],
+                        help='member counts to benchmark')
+    parser.add_argument('--years', type=int, default=5, help='years of history')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the fastest is kept')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the results to')
+    parser.add_argument('--baseline', default=str(BASELINE), help='baseline results file to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction slower than the baseline reported as a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(module)-12s %(levelname)-8s %(message)s')
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(unknown)))
+
+    history = list(range(2014, 2014 + args.years))
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        print('Running {}...'.format(name))
+        results.update(BENCHMARKS[name](args.members, history, args.repeat))
+    output = {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'results': results}
+
+    baseline = {}
+    if Path(args.baseline).is_file():
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for filename in [args.output] + ([args.baseline] if args.save_baseline else []):
+        with open(filename, 'w') as f:
+            json.dump(output, f, indent=2)
+        print('Results written to {}'.format(filename))
+    raise SystemExit(1 if regressions else 0)
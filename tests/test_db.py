@@ -0,0 +1,48 @@
+from topline.transaction import Transaction
+from benchmarks.generate import ACCOUNTS, get_usernames, make_transactions, write_statement
+from benchmarks.run import create_db
+
+
+def get_summary(db):
+    # return the monthly summary rows with totals rounded, as totals summed in a different order differ in the
+    # last float digits
+    return [row[:5] + (round(row[5], 6), row[6]) for row in db.get_monthly_summary()]
+
+
+def test_monthly_summary_matches_a_rebuild(tmp_path):
+    db = create_db(tmp_path, 20)
+    usernames = get_usernames(20)
+    # statements are added in small TransactionBatch chunks, so months span several batches, and the last year
+    # as lists of Transaction
+    for acc_num, _ in ACCOUNTS:
+        statement = tmp_path.joinpath('{}.csv'.format(acc_num))
+        write_statement(statement, usernames, [2016, 2017], account=acc_num)
+        db.import_statement(str(statement), chunk_size=5)
+    Transaction.usernames = db.get_usernames()
+    Transaction.accounts = db.get_accounts()
+    transactions = [Transaction(trans, account) for trans, account in make_transactions(usernames, [2018])]
+    for t in transactions:
+        t.process_transaction()
+    db.ingest_transactions(transactions[:len(transactions) // 2])
+    db.ingest_transactions(transactions)
+
+    incremental = get_summary(db)
+    assert incremental
+    assert db.rebuild_monthly_summary() == len(incremental)
+    assert get_summary(db) == incremental
+    db.close_db()
+
+
+def test_reports_read_the_monthly_summary(tmp_path):
+    db = create_db(tmp_path, 5)
+    statement = tmp_path.joinpath('statement.csv')
+    write_statement(statement, get_usernames(5), [2017])
+    db.import_statement(str(statement))
+    contributions = db.cursor.execute('''SELECT user_id, contrib_year, SUM(amount) FROM transactions
+                                         WHERE contrib_month IS NOT NULL GROUP BY user_id, contrib_year''').fetchall()
+    assert [(u, y, round(t, 6)) for u, _, y, t in db.get_yearly_totals()] == \
+        [(u, y, round(t, 6)) for u, y, t in contributions]
+    assert {t[2] for t in db.get_yearly_totals(2018)} == {2018}
+    months, rows = db.get_contribution_matrix((2017, 3), (2018, 2))
+    assert round(sum(sum(amounts) for _, _, amounts in rows), 6) == round(sum(t for _, _, t in contributions), 6)
+    db.close_db()
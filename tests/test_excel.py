@@ -0,0 +1,119 @@
+from datetime import date
+from pathlib import Path
+import openpyxl
+from topline.excel import Excel, ExcelExport, ExcelReader, get_sheet_range, month_index, user_row, income_row, \
+    last_income_row, expense_row
+from topline.transaction import Transaction
+from benchmarks.generate import get_usernames, make_transactions, write_workbook
+from benchmarks.run import set_users
+
+
+def get_sheet_names(export, first, last):
+    # return the names of the sheets that the (year, month) months first to last are written to
+    names = []
+    for index in range(month_index(*first), month_index(*last) + 1):
+        name = export.get_period(index)[2]
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def test_sheets_start_in_first_month(tmp_path):
+    export = ExcelExport(tmp_path.joinpath('export.xlsx'), first_month=11)
+    assert get_sheet_names(export, (2017, 11), (2019, 10)) == ['NOV 17 - OCT 18', 'NOV 18 - OCT 19']
+    export = ExcelExport(tmp_path.joinpath('export.xlsx'))
+    assert get_sheet_names(export, (2018, 1), (2018, 3)) == ['MAR 17 - FEB 18', 'MAR 18 - FEB 19']
+
+
+def test_sheets_continue_from_the_existing_workbook(tmp_path):
+    names = ["NOV '16 - OCT '17", 'NOV 17 - JUN 18']
+    export = ExcelExport(tmp_path.joinpath('export.xlsx'), [(n, get_sheet_range(n)) for n in names])
+    assert get_sheet_names(export, (2015, 1), (2019, 12)) == [
+        'NOV 14 - OCT 15', 'NOV 15 - OCT 16', "NOV '16 - OCT '17", 'NOV 17 - JUN 18', 'JUL 18 - JUN 19',
+        'JUL 19 - JUN 20']
+    # a month between two sheets is written to a sheet that fills the gap
+    export = ExcelExport(tmp_path.joinpath('export.xlsx'), [('MAR 17 - FEB 18', [3, 17, 2, 18]),
+                                                            ('JUN 18 - MAY 19', [6, 18, 5, 19])])
+    assert export.get_period(month_index(2018, 4))[2] == 'MAR 18 - MAY 18'
+
+
+class SheetTransactions:
+    # the DB methods ExcelExport reads, over a fixed list of DB.get_sheet_transactions rows
+    def __init__(self, usernames, transactions):
+        self.usernames = usernames
+        self.transactions = transactions
+
+    def get_usernames(self):
+        return [(i, username, None) for i, username in enumerate(self.usernames, 1)]
+
+    def get_account_balances(self):
+        return [(62000000001, 1500.0, 1)]
+
+    def get_sheet_transactions(self):
+        return iter(sorted(self.transactions, key=lambda t: (month_index(t[1], t[2]), t[0])))
+
+
+def test_export_writes_transactions_to_their_month_column(tmp_path):
+    filename = tmp_path.joinpath('export.xlsx')
+    db = SheetTransactions(['UAA', 'UAB'], [
+        (1, 2018, 3, 62000000001, 'UAA', 'contribution', 'PAYMENT FROM UAA', 'UAA - MAR18', 250.0),
+        (2, 2018, 3, 62000000001, 'UAB', 'contribution', 'PAYMENT FROM UAB', 'UAB - MAR18', 300.0),
+        (3, 2018, 4, 62000000001, None, 'income', 'INTEREST', 'APR', 12.5),
+        (4, 2018, 4, 62000000001, None, 'income', 'REFUND', 'APR', 20.0),
+        (5, 2018, 4, 62000000001, None, 'expense', 'MONTHLY ACCOUNT FEE', '', -55.0),
+        (6, 2018, 4, 62000000001, None, 'expense', 'BANK CHARGES', 'APR', -5.0),
+        (7, 2019, 2, 62000000001, 'UAA', 'contribution', 'PAYMENT FROM UAA', 'UAA - FEB19', 250.0),
+        (8, 2019, 3, 62000000001, 'UAB', 'contribution', 'PAYMENT FROM UAB', 'UAB - MAR19', 300.0),
+    ])
+    assert ExcelExport(filename).export(db, until=(2019, 3)) == 8
+
+    reader = ExcelReader(filename)
+    assert reader.sheet_names == ['MAR 18 - FEB 19', 'MAR 19 - FEB 20']
+    assert [u[1] for u in reader.user_ids] == ['UAA', 'UAB']
+    assert reader.get_column_headers('MAR 18 - FEB 19')[1:] == [[m, 18] for m in range(3, 13)] + [[1, 19], [2, 19]]
+    rows = reader.get_values('MAR 18 - FEB 19', min_row=user_row, max_row=user_row + 1, max_col=13)
+    assert rows == [['UAA', 250] + [None] * 10 + [250], ['UAB', 300] + [None] * 11]
+    income = reader.get_values('MAR 18 - FEB 19', min_row=income_row, max_row=last_income_row, min_col=3, max_col=3)
+    assert income == [[12.5], [20]]
+    expenses = reader.get_values('MAR 18 - FEB 19', min_row=expense_row, max_row=expense_row + 1, min_col=3,
+                                 max_col=3)
+    assert expenses == [[55], [5]]
+    assert reader.get_values('MAR 19 - FEB 20', min_row=user_row + 1, max_row=user_row + 1, max_col=2) == \
+        [['UAB', 300]]
+    reader.close()
+
+
+def test_archive_years_after_saving_the_workbook(tmp_path):
+    filename = tmp_path.joinpath('tracking.xlsx')
+    usernames = write_workbook(filename, get_usernames(5), [2017, 2018, 2019])
+    set_users(usernames)
+    Excel.user_ids = None
+    excel = Excel(str(filename))
+    for trans, account in make_transactions(usernames, [2017, 2018]):
+        t = Transaction(trans, account)
+        t.process_transaction()
+        if t.type != 'unknown':
+            excel.add_transaction(t)
+    excel.close_workbook()
+    saved = ExcelReader(filename)
+    values = {name: saved.get_values(name) for name in saved.sheet_names}
+    saved.close()
+
+    archived = excel.archive_years(tmp_path.joinpath('archive'), date(2019, 4, 1))
+    assert [Path(path).name for path in archived] == ['tracking MAR 17 - FEB 18.xlsx', 'tracking MAR 18 - FEB 19.xlsx']
+    assert excel.sheet_names == ['MAR 19 - FEB 20']
+    for path in archived:
+        archive = openpyxl.load_workbook(path)
+        sheet = archive.worksheets[0]
+        assert archive.sheetnames == [sheet.title]
+        assert sheet.protection.sheet
+        # income and expenses are written with comments, which openpyxl can only save once per sheet
+        assert any(cell.comment for row in sheet.iter_rows() for cell in row)
+        assert ExcelReader(path).get_values(sheet.title) == values[sheet.title]
+    assert openpyxl.load_workbook(filename).sheetnames == ['Summary', 'MAR 19 - FEB 20']
+
+    # the working file can be opened and saved again
+    Excel.user_ids = None
+    excel = Excel(str(filename))
+    excel.close_workbook()
+    Excel.user_ids = None
@@ -0,0 +1,34 @@
+from topline.importer import read_statement
+from benchmarks.generate import CHEQUE_ACCOUNT, get_usernames, write_statement
+from benchmarks.run import create_db
+
+OFX = """OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<BANKACCTFROM><ACCTID>{account}</BANKACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20180305<TRNAMT>250.00<NAME>FNB APP PAYMENT FROM UAA<MEMO>UAA - MAR18</STMTTRN>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED><TRNAMT>500.00<NAME>FNB APP PAYMENT FROM UAB<MEMO>UAB - MAR18</STMTTRN>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20180328120000<TRNAMT>-65.00<NAME>MONTHLY ACCOUNT FEE<MEMO></STMTTRN>
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+def test_ofx_transactions_without_a_date_are_skipped(tmp_path):
+    statement = tmp_path.joinpath('statement.ofx')
+    statement.write_text(OFX.format(account=CHEQUE_ACCOUNT))
+    assert list(read_statement(statement)) == [
+        (('05 Mar 2018', 'FNB APP PAYMENT FROM UAA', 'UAA - MAR18', '', '250.00', ''), CHEQUE_ACCOUNT),
+        (('28 Mar 2018', 'MONTHLY ACCOUNT FEE', '', '', '-65.00', ''), CHEQUE_ACCOUNT)]
+    db = create_db(tmp_path, 5)
+    assert db.import_statement(str(statement)) == 2
+    db.close_db()
+
+
+def test_transactions_of_unknown_accounts_are_skipped(tmp_path):
+    db = create_db(tmp_path, 5)
+    statement = tmp_path.joinpath('statement.csv')
+    count = write_statement(statement, get_usernames(5), [2018])
+    assert db.import_statement(str(statement), account=62000000099, chunk_size=50) == 0
+    assert db.import_statement(str(statement), chunk_size=50) == count
+    db.close_db()
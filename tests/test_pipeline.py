@@ -0,0 +1,119 @@
+import ast
+import json
+from pathlib import Path
+import pytest
+from topline.pipeline import Pipeline
+
+TOPLINE = Path(__file__).parent.parent.joinpath('topline.py')
+
+
+def make_pipeline(checkpoint_dir, run_id='2026-10', fail=()):
+    # a pipeline of three stages that records which stages ran
+    pipeline = Pipeline(checkpoint_dir, run_id=run_id)
+    pipeline.ran = []
+
+    def stage(name, result):
+        def run():
+            pipeline.ran.append(name)
+            if name in fail:
+                raise RuntimeError(name)
+            return result
+        return run
+
+    pipeline.stage('scrape')(stage('scrape', {'1': [1, 2]}))
+    pipeline.stage('database', requires=['scrape'])(stage('database', {'1': [3]}))
+    pipeline.stage('excel', requires=['database'])(stage('excel', 'tracking.xlsx'))
+    return pipeline
+
+
+def test_checkpoints_are_loaded_when_resuming(tmp_path):
+    assert make_pipeline(tmp_path).run()
+    pipeline = make_pipeline(tmp_path)
+    assert pipeline.run(start='excel')
+    assert pipeline.ran == ['excel']
+    assert pipeline.results['database'] == {'1': [3]}
+
+
+def test_checkpoints_from_another_run_are_rejected(tmp_path):
+    assert make_pipeline(tmp_path, run_id='2026-09').run()
+    pipeline = make_pipeline(tmp_path, run_id='2026-10')
+    assert not pipeline.run(start='excel')
+    assert pipeline.ran == []
+
+
+def test_checkpoints_without_a_run_id_are_rejected(tmp_path):
+    tmp_path.joinpath('database.json').write_text(json.dumps({'1': [3]}))
+    pipeline = make_pipeline(tmp_path)
+    assert not pipeline.run(only='excel')
+    assert pipeline.ran == []
+
+
+def test_failed_stage_fails_the_run(tmp_path):
+    pipeline = make_pipeline(tmp_path, fail=['database'])
+    assert not pipeline.run()
+    assert pipeline.ran == ['scrape', 'database']
+    assert not tmp_path.joinpath('database.json').exists()
+
+
+def test_progress_is_kept_until_the_stage_completes(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    assert pipeline.load_progress('database') is None
+    pipeline.save_progress('database', {'1': [3]})
+    assert make_pipeline(tmp_path).load_progress('database') == {'1': [3]}
+    assert make_pipeline(tmp_path, run_id='2026-11').load_progress('database') is None
+    assert pipeline.run()
+    assert pipeline.load_progress('database') is None
+
+
+def make_pipeline_with_backup(checkpoint_dir):
+    # backup reads the result of database, which it only requires through excel
+    pipeline = make_pipeline(checkpoint_dir)
+    pipeline.stage('backup', requires=['excel'])(lambda: pipeline.results['database'])
+    return pipeline
+
+
+def test_indirect_requirements_are_loaded(tmp_path):
+    assert make_pipeline_with_backup(tmp_path).run()
+    for name in ['database', 'excel', 'backup']:
+        assert make_pipeline_with_backup(tmp_path).run(start=name), name
+        assert make_pipeline_with_backup(tmp_path).run(only=name), name
+
+
+def get_topline_stages():
+    # return {stage: (requires, checkpoint, results read)} for the stages defined in topline.py
+    tree = ast.parse(TOPLINE.read_text())
+    stages = {}
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        for decorator in node.decorator_list:
+            if isinstance(decorator, ast.Call) and getattr(decorator.func, 'attr', None) == 'stage':
+                options = {k.arg: ast.literal_eval(k.value) for k in decorator.keywords}
+                reads = {n.slice.value for n in ast.walk(node) if isinstance(n, ast.Subscript)
+                         and isinstance(n.value, ast.Attribute) and n.value.attr == 'results'}
+                stages[decorator.args[0].value] = (options.get('requires', []), options.get('checkpoint', True),
+                                                   reads)
+    return stages
+
+
+def make_topline_pipeline(checkpoint_dir, stages):
+    # a pipeline with the stages of topline.py, where each stage only reads the results topline.py's stage reads
+    pipeline = Pipeline(checkpoint_dir, run_id='2026-10')
+    for name, (requires, checkpoint, reads) in stages.items():
+        pipeline.stage(name, requires=requires, checkpoint=checkpoint)(
+            lambda name=name, reads=reads: [pipeline.results[r] for r in sorted(reads)] and name)
+    return pipeline
+
+
+def test_topline_stages_require_the_results_they_read():
+    for name, (requires, _, reads) in get_topline_stages().items():
+        assert reads <= set(requires), name
+
+
+@pytest.mark.parametrize('mode', ['start', 'only'])
+def test_topline_stages_can_be_resumed(tmp_path, mode):
+    stages = get_topline_stages()
+    assert make_topline_pipeline(tmp_path, stages).run()
+    for name in stages:
+        pipeline = make_topline_pipeline(tmp_path, stages)
+        assert pipeline.run(**{mode: name}), name
@@ -0,0 +1,105 @@
+import os
+import pytest
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+from topline.scraper import FNB, WaitPolicy
+from benchmarks.generate import ACCOUNTS, get_usernames, write_fnb_site
+
+# browser used for the tests. TOPLINE_DRIVER_PATH is the path to chromedriver when using chrome
+DRIVER = os.environ.get('TOPLINE_DRIVER', 'firefox')
+DRIVER_PATH = os.environ.get('TOPLINE_DRIVER_PATH')
+
+SITE_ACCOUNTS = ACCOUNTS + [(62000000003, 'Money Market'), (62000000004, 'Call Account'),
+                            (62000000005, 'Tax Free Savings')]
+
+
+@pytest.fixture(scope='module')
+def browser():
+    fnb = FNB(DRIVER, headless=True, driver_path=DRIVER_PATH)
+    if not fnb.driver:
+        pytest.skip('No {} browser available'.format(DRIVER))
+    fnb.driver.quit()
+
+
+@pytest.fixture(scope='module')
+def site(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('fnb')
+    accounts = write_fnb_site(folder, get_usernames(12), [2019, 2020], accounts=SITE_ACCOUNTS)
+    return folder.joinpath('login.html').as_uri(), accounts
+
+
+def open_sessions(url, count, **options):
+    return FNB.open_sessions(count, url, 'user', 'pass', driver=DRIVER, headless=True, driver_path=DRIVER_PATH,
+                             wait_policy=WaitPolicy(timeout=10), **options)
+
+
+def read_accounts(url, workers, **options):
+    sessions = open_sessions(url, workers, **options)
+    assert len(sessions) == workers
+    fnb = sessions.pop(0)
+    try:
+        assert fnb.get_accounts(get_transactions=True, sessions=sessions)
+        return fnb.accounts
+    finally:
+        for session in [fnb] + sessions:
+            session.driver.quit()
+
+
+@pytest.mark.parametrize('script_extraction', [True, False])
+def test_get_accounts(browser, site, script_extraction):
+    url, expected = site
+    accounts = read_accounts(url, 1, script_extraction=script_extraction)
+    assert list(accounts) == list(expected)
+    assert accounts == expected
+
+
+@pytest.mark.parametrize('workers', [2, 3, 6])
+def test_get_accounts_concurrently(browser, site, workers):
+    url, expected = site
+    accounts = read_accounts(url, workers)
+    # accounts keep the order of the accounts page and every transaction is read once, newest first
+    assert list(accounts) == list(expected)
+    for acc_num, account in expected.items():
+        assert accounts[acc_num]['transactions'] == account['transactions']
+    assert accounts == expected
+
+
+class StubDriver:
+    def __init__(self, error=None):
+        self.error = error
+        self.quit_called = False
+
+    def get(self, url):
+        if self.error:
+            raise self.error
+
+    def quit(self):
+        self.quit_called = True
+
+
+class StubFNB(FNB):
+    # FNB with stub drivers handed out in order, raising the given errors from driver.get
+    drivers = []
+
+    def __init__(self, **options):
+        self.driver = self.drivers.pop(0)
+
+    def login(self, username, password):
+        if username == 'rejected':
+            self.driver.quit()
+            raise SystemExit(0)
+        return True
+
+
+def test_open_sessions_closes_failed_sessions_and_keeps_the_rest():
+    drivers = [StubDriver(), StubDriver(WebDriverException('unreachable')), StubDriver(),
+               StubDriver(NoSuchElementException('user'))]
+    StubFNB.drivers = list(drivers)
+    sessions = StubFNB.open_sessions(4, 'login.html', 'user', 'pass')
+    assert sorted(id(s.driver) for s in sessions) == sorted(id(d) for d in (drivers[0], drivers[2]))
+    assert [d.quit_called for d in drivers] == [False, True, False, True]
+
+    drivers = [StubDriver(), StubDriver()]
+    StubFNB.drivers = list(drivers)
+    with pytest.raises(SystemExit):
+        StubFNB.open_sessions(2, 'login.html', 'rejected', 'pass')
+    assert all(d.quit_called for d in drivers)
@@ -1,17 +1,35 @@
+import argparse
 import configparser
 import logging
+import sqlite3
 from logging.config import fileConfig
 from datetime import datetime, date
 from shutil import copy2
 from pathlib import Path
 import zipfile
-from topline.scraper import FNB
-from topline.excel import Excel
+from topline.scraper import FNB, WaitPolicy
+from topline.excel import Excel, ExcelExport, ExcelReader
 from topline.db import DB
 from topline.transaction import Transaction
 from topline.gmail import Gmail
+from topline.pipeline import Pipeline
+from topline.metrics import metrics
 from topline import MONTHS
 
+parser = argparse.ArgumentParser(description='Topline automated contribution tracker')
+parser.add_argument('--from', dest='start', metavar='STAGE',
+                    help='resume from STAGE, loading the results of earlier stages from their checkpoints')
+parser.add_argument('--only', metavar='STAGE', help='run only STAGE, loading earlier results from their checkpoints')
+parser.add_argument('--list', action='store_true', help='list the pipeline stages and exit')
+parser.add_argument('--drain', action='store_true', help='only send emails still pending in the outbox')
+parser.add_argument('--requeue-interrupted', action='store_true',
+                    help='with --drain, also send emails left as sending by an interrupted run')
+parser.add_argument('--export-workbook', metavar='FILE',
+                    help='write a new tracking workbook from the database to FILE and exit')
+parser.add_argument('--rebuild-summary', action='store_true',
+                    help='rebuild the monthly summary table from the transactions table and exit')
+args = parser.parse_args()
+
 now = datetime.now()
 Path('logs').mkdir(exist_ok=True)
 backup = Path('backup')
@@ -37,124 +55,240 @@ try:
         path_to_driver = config['SCRAPER']['DRIVER_PATH']
     db_file = config['DB']['FILENAME']
     excel_file = config['EXCEL']['FILENAME']
+    archive_dir = config.get('EXCEL', 'ARCHIVE_DIR', fallback=None)
+    first_month = config.getint('EXCEL', 'FIRST_MONTH', fallback=3)
+    checkpoint_dir = config.get('PIPELINE', 'CHECKPOINT_DIR', fallback='checkpoints')
 except KeyError:
     logger.error("Error getting config from config.ini file")
     raise SystemExit(0)
 
-db = DB(db_file)
+if config.getboolean('METRICS', 'ENABLED', fallback=False):
+    metrics.enable()
+metrics_files = {'json_file': config.get('METRICS', 'JSON_FILE', fallback='metrics/metrics.json'),
+                 'prometheus_file': config.get('METRICS', 'PROMETHEUS_FILE', fallback='metrics/topline.prom')}
+
+db_options = {key: config['DB'][key] for key in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'timeout')
+              if key in config['DB']}
+db = DB(db_file, **db_options)
 if not db.connection:
     logger.error('DB error')
     raise SystemExit(0)
 
-fnb = FNB(driver=driver, headless=False, driver_path=path_to_driver)
+if args.export_workbook:
+    # the exported sheets cover the same months as the sheets of the tracking workbook
+    sheets = []
+    if Path(excel_file).is_file():
+        reader = ExcelReader(excel_file)
+        sheets = list(zip(reader.sheet_names, reader.sheet_list))
+        reader.close()
+    ExcelExport(args.export_workbook, sheets, first_month).export(db, until=(now.year, now.month))
+    db.close_db()
+    raise SystemExit(0)
 
-if fnb.driver:
-    fnb.driver.get(url)
-    if fnb.login(username, password):
-        fnb.get_accounts(get_transactions=True)
-        logger.debug("transactions = %s", fnb.accounts)
-        fnb.logout()
-    else:
-        fnb.driver.quit()
+if args.rebuild_summary:
+    db.rebuild_monthly_summary()
+    db.close_db()
+    raise SystemExit(0)
 
-db_usernames = db.get_usernames()
-if not db_usernames:
-    logger.error("No users found in database.")
+if args.drain:
+    if args.requeue_interrupted:
+        db.requeue_interrupted_emails()
+    gmail = Gmail()
+    if gmail.authenticate():
+        gmail.send_outbox(db)
+    db.close_db()
+    metrics.write(**metrics_files)
     raise SystemExit(0)
-cur_accounts = list(fnb.accounts.keys())
-db_accounts = db.get_accounts()
-db_account_numbers = [account[0] for account in db_accounts]
-
-for acc in list(set(cur_accounts).union(db_account_numbers)):
-    if acc in cur_accounts and acc in db_account_numbers:
-        db.update_account(acc, fnb.accounts[acc]['name'], float(fnb.accounts[acc]['balance']))
-    elif acc in cur_accounts:
-        db.add_account(acc, fnb.accounts[acc]['name'], float(fnb.accounts[acc]['balance']))
-    elif acc in db_account_numbers and db_accounts[db_account_numbers.index(acc)][2]:
-        db.set_account_inactive(acc)
-        print("Account {} set to inactive. Manually update database and excel sheet with any missing transactions now!"
-              .format(acc))
-        input("Press ENTER when done!")
 
-Transaction.usernames = db_usernames
-Transaction.accounts = db.get_accounts()
-
-excel = Excel(excel_file)
-if excel.workbook:
-    for account in fnb.accounts:
-        logger.info("Processing transactions in account: %s - %s", account, fnb.accounts[account]['name'])
-        count = 0
-        db_count = 0
-        excel_count = 0
-        transaction_count = len(fnb.accounts[account]['transactions'])
-        if transaction_count > 0:
-            for trans in reversed(fnb.accounts[account]['transactions']):
-                count += 1
-                logger.debug("Processing transaction %s/%s: date = %s, desc = %s, ref = %s, amount = %s.",
-                             count, transaction_count, trans[0], trans[1], trans[2], trans[4])
-                t = Transaction(trans, account)
-                if db.check_transaction(t.account, t.date, t.description, t.reference, t.amount):
-                    continue
-                t.process_transaction()
-                t.transaction_id = db.add_transaction(t.account, t.date, t.description, t.reference, t.amount,
-                                                      t.user_id, t.month, t.year)
-                if t.transaction_id:
-                    db.update_user(t.user_id, t.username, t.date, t.amount, t.transaction_id)
-                    db_count += 1
+logfile = [h.baseFilename for h in logger.handlers if type(h) == logging.FileHandler][0]
+# emails, backups and idempotency keys are named by month, so only checkpoints from this month are loaded
+pipeline = Pipeline(checkpoint_dir, run_id=now.strftime('%Y-%m'))
+
+
+@pipeline.stage('scrape')
+def scrape():
+    # read accounts and new transactions from FNB online banking
+    wait_policy = WaitPolicy(timeout=config['SCRAPER'].getfloat('WAIT_TIMEOUT', 30),
+                             poll_frequency=config['SCRAPER'].getfloat('WAIT_POLL', 0.05),
+                             backoff=config['SCRAPER'].getfloat('WAIT_BACKOFF', 1.5))
+    # all sessions log in at the same time. Extra sessions read accounts concurrently
+    sessions = FNB.open_sessions(config['SCRAPER'].getint('WORKERS', 1), url, username, password, driver=driver,
+                                 headless=False, driver_path=path_to_driver, wait_policy=wait_policy)
+    if not sessions:
+        return {}
+    fnb = sessions.pop(0)
+    # only read transactions after the latest already in the database
+    marks = {acc[0]: db.get_high_water_mark(acc[0]) for acc in db.get_accounts()}
+    fnb.get_accounts(get_transactions=True, sessions=sessions, marks=marks)
+    logger.debug("transactions = %s", fnb.accounts)
+    for session in sessions:
+        session.logout()
+    fnb.logout()
+    for name, (count, total, timeouts) in wait_policy.summary().items():
+        logger.info("Waited for %s %s times: %.2fs total, %s timeouts", name, count, total, timeouts)
+    return fnb.accounts
+
+
+@pipeline.stage('authenticate', checkpoint=False)
+def authenticate():
+    gmail = Gmail()
+    gmail.authenticate()
+    return gmail
+
+
+@pipeline.stage('workbook', checkpoint=False)
+def load_workbook():
+    return Excel(excel_file)
+
+
+@pipeline.stage('database', requires=['scrape'])
+def update_database():
+    # sync accounts and add new transactions to the database. Returns the ids of the added transactions by account
+    accounts = pipeline.results['scrape']
+    cur_accounts = [int(acc) for acc in accounts]
+    db_accounts = db.get_accounts()
+    db_account_numbers = [account[0] for account in db_accounts]
+
+    for acc in list(set(cur_accounts).union(db_account_numbers)):
+        if acc in cur_accounts and acc in db_account_numbers:
+            db.update_account(acc, accounts[str(acc)]['name'], float(accounts[str(acc)]['balance']))
+        elif acc in cur_accounts:
+            db.add_account(acc, accounts[str(acc)]['name'], float(accounts[str(acc)]['balance']))
+        elif acc in db_account_numbers and db_accounts[db_account_numbers.index(acc)][2]:
+            db.set_account_inactive(acc)
+            print("Account {} set to inactive. Manually update database and excel sheet with any missing "
+                  "transactions now!".format(acc))
+            input("Press ENTER when done!")
+
+    Transaction.accounts = db.get_accounts()
+    # each account is committed separately. Ids committed by an earlier attempt that failed are kept, as they
+    # are skipped as duplicates now and would otherwise never be written to the workbook
+    added_ids = pipeline.load_progress('database') or {}
+    for account in accounts:
+        transactions = [Transaction(trans, int(account)) for trans in reversed(accounts[account]['transactions'])]
+        added = [t.transaction_id for t in db.ingest_transactions(transactions)]
+        added_ids[account] = added_ids.get(account, []) + added
+        pipeline.save_progress('database', added_ids)
+        logger.info("Processed %s transactions in account: %s. %s added to database",
+                    len(transactions), accounts[account]['name'], len(added))
+    return added_ids
+
+
+@pipeline.stage('excel', requires=['scrape', 'database', 'workbook'])
+def update_excel():
+    # write the added transactions and account balances to the workbook and copy it to the backup folder
+    accounts = pipeline.results['scrape']
+    Transaction.accounts = db.get_accounts()
+    excel = pipeline.results['workbook']
+    if excel.workbook:
+        for account in accounts:
+            logger.info("Processing transactions in account: %s - %s", account, accounts[account]['name'])
+            excel_count = 0
+            added_ids = pipeline.results['database'].get(account, [])
+            if added_ids:
+                added = db.get_transactions(added_ids)
+                db_count = len(added)
+                for count, t in enumerate(added, 1):
+                    logger.debug("Processing transaction %s/%s: date = %s, desc = %s, ref = %s, amount = %s.",
+                                 count, db_count, t.date, t.description, t.reference, t.amount)
                     if t.type != 'unknown':
                         if excel.add_transaction(t):
                             excel_count += 1
-            logger.info("Processed %s transactions in account: %s. %s added to database, %s written to excel",
-                        transaction_count, fnb.accounts[account]['name'], db_count, excel_count)
-            excel.update_account_balances(account, float(fnb.accounts[account]['balance']))
-        else:
-            logger.info('No transactions for account: %s', fnb.accounts[account]['name'])
-    excel.set_updating_member('Topline', now.month, now.year)
-    excel.close_workbook(overwrite=True)
-
-wb_backup = 'backup/TOPLINE TRACKING SHEET - {}.xlsx'.format(now.strftime('%B %Y'))
-copy2(excel_file, wb_backup)
-
-user_details = db.get_users()
-gmail = Gmail()
-gmail.authenticate()
-for user in user_details:
-    if user[4] != "TIG" and user[9] is not None:
-        logger.debug("User details: %s", user)
-        next_date = date(year=user[5].year + user[5].month // 12, month=user[5].month % 12 + 1, day=5)
-        if next_date < date(year=now.year + now.month // 12, month=now.month % 12 + 1, day=5):
-            next_date = date(year=now.year + now.month // 12, month=now.month % 12 + 1, day=5)
-        msg = (f"Dear {user[1]} {user[2]},\n\n"
-               f"Please find attached the tracking sheet for {MONTHS[now.month][0].capitalize()} {now.year}.\n\n"
-               f"Your last contribution of R {user[6]:.2f} was received on {user[5].strftime('%d %B, %Y')} "
-               f"for {user[7]} {user[8]}.\n"
-               f"Your total contribution to date is R {user[9]:.2f} for a total share of {user[10]:.2f}%\n"
-               f"Your next contribution is due by {next_date.strftime('%d %B, %Y')}. "
-               f"The reference should be: {user[4]}-{next_date.strftime('%b-%y').upper()}.\n\n"
-               f"Please ensure that all details contained in this email and the tracking sheet are correct.\n"
-               f"If any errors are found, please contact thassan743@gmail.com.\n\n"
-               f"Thank you.\n"
-               f"The Topline Automated Contribution Tracker")
-
-        logger.info("Sending email to %s %s: %s", user[1], user[2], user[3])
-        message = gmail.create_message(user[3], 'Tracking - {}'.format(now.strftime('%B %Y')),
-                                       msg, wb_backup)
-        gmail.send_message('me', message)
+                logger.info("%s transactions in account: %s written to excel", excel_count, accounts[account]['name'])
+            else:
+                logger.info('No transactions for account: %s', accounts[account]['name'])
+            # balances are cleared when the workbook is opened, so every account's balance is written each run
+            excel.update_account_balances(int(account), float(accounts[account]['balance']))
+        excel.set_updating_member('Topline', now.month, now.year)
+        excel.close_workbook(overwrite=True)
+        if archive_dir:
+            # keep the previous year in the workbook for a month after it ends, for late transactions
+            excel.archive_years(archive_dir, date(now.year - (now.month == 1), (now.month - 2) % 12 + 1, 1))
 
-logfile = [h.baseFilename for h in logger.handlers if type(h) == logging.FileHandler][0]
-logger.info("Sending logfile {}".format(logfile))
-message = gmail.create_message('thassan743@gmail.com', 'Logfile - {}'.format(now.strftime('%B %Y')),
-                               "Logfile for {}".format(now.strftime('%B %Y')), logfile)
-gmail.send_message('me', message)
+    wb_backup = 'backup/TOPLINE TRACKING SHEET - {}.xlsx'.format(now.strftime('%B %Y'))
+    copy2(excel_file, wb_backup)
+    return wb_backup
 
-db.close_db()
 
-logger.info("Making backup of database and excel workbook files.")
-zip_path = backup.joinpath('backup_{}.zip'.format(now.strftime('%Y%m%d_%H%M%S')))
-logger.info("Backup path: %s", zip_path)
-with zipfile.ZipFile(zip_path, 'w') as myzip:
-    myzip.write(db_file)
-    myzip.write(logfile, Path(logfile).name)
-    myzip.write(wb_backup, Path(wb_backup).name)
+@pipeline.stage('queue', requires=['excel'])
+def queue_emails():
+    # queue the tracking sheet for each member and the logfile in the outbox
+    wb_backup = pipeline.results['excel']
+    user_details = db.get_users()
+    # contributions made for this year, from the monthly summary
+    year_totals = {user_id: total for user_id, _, _, total in db.get_yearly_totals(now.year)}
+    queued = 0
+    for user in user_details:
+        if user[4] != "TIG" and user[9] is not None:
+            logger.debug("User details: %s", user)
+            next_date = date(year=user[5].year + user[5].month // 12, month=user[5].month % 12 + 1, day=5)
+            if next_date < date(year=now.year + now.month // 12, month=now.month % 12 + 1, day=5):
+                next_date = date(year=now.year + now.month // 12, month=now.month % 12 + 1, day=5)
+            msg = (f"Dear {user[1]} {user[2]},\n\n"
+                   f"Please find attached the tracking sheet for {MONTHS[now.month][0].capitalize()} {now.year}.\n\n"
+                   f"Your last contribution of R {user[6]:.2f} was received on {user[5].strftime('%d %B, %Y')} "
+                   f"for {user[7]} {user[8]}.\n"
+                   f"Your total contribution to date is R {user[9]:.2f} for a total share of {user[10]:.2f}%\n"
+                   f"Your contributions for {now.year} total R {year_totals.get(user[0], 0):.2f}.\n"
+                   f"Your next contribution is due by {next_date.strftime('%d %B, %Y')}. "
+                   f"The reference should be: {user[4]}-{next_date.strftime('%b-%y').upper()}.\n\n"
+                   f"Please ensure that all details contained in this email and the tracking sheet are correct.\n"
+                   f"If any errors are found, please contact thassan743@gmail.com.\n\n"
+                   f"Thank you.\n"
+                   f"The Topline Automated Contribution Tracker")
+
+            logger.info("Queueing email to %s %s: %s", user[1], user[2], user[3])
+            queued += db.queue_email('tracking-{}-{}'.format(now.strftime('%Y%m'), user[3]), user[3],
+                                     'Tracking - {}'.format(now.strftime('%B %Y')), msg, wb_backup)
+
+    logger.info("Queueing logfile {}".format(logfile))
+    queued += db.queue_email('logfile-{}'.format(Path(logfile).name), 'thassan743@gmail.com',
+                             'Logfile - {}'.format(now.strftime('%B %Y')),
+                             "Logfile for {}".format(now.strftime('%B %Y')), logfile)
+    return queued
+
+
+@pipeline.stage('email', requires=['queue', 'authenticate'])
+def send_emails():
+    # send everything pending in the outbox
+    return pipeline.results['authenticate'].send_outbox(db)
+
+
+@pipeline.stage('backup', requires=['queue', 'excel'])
+def make_backup():
+    # runs while the emails are sent, so the database is copied with a reader connection to get a consistent file
+    logger.info("Making backup of database and excel workbook files.")
+    wb_backup = pipeline.results['excel']
+    zip_path = backup.joinpath('backup_{}.zip'.format(now.strftime('%Y%m%d_%H%M%S')))
+    db_copy = backup.joinpath(Path(db_file).name)
+    target = sqlite3.connect(str(db_copy))
+    with db.reader() as source:
+        source.backup(target)
+    target.close()
+    logger.info("Backup path: %s", zip_path)
+    with zipfile.ZipFile(zip_path, 'w') as myzip:
+        myzip.write(db_copy, db_file)
+        myzip.write(logfile, Path(logfile).name)
+        myzip.write(wb_backup, Path(wb_backup).name)
+    db_copy.unlink()
+    return str(zip_path)
+
+
+if args.list:
+    print('\n'.join(pipeline.names))
+    raise SystemExit(0)
+
+db_usernames = db.get_usernames()
+if not db_usernames:
+    logger.error("No users found in database.")
+    raise SystemExit(0)
+Transaction.usernames = db_usernames
+
+completed = pipeline.run(start=args.start, only=args.only)
+db.close_db()
+metrics.write(**metrics_files)
+if not completed:
+    logger.error("Pipeline failed")
+    raise SystemExit(1)
 
 logger.info("Done")
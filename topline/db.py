@@ -2,21 +2,98 @@ import sqlite3
 import json
 from pathlib import Path
 import logging
-import csv
-from topline.transaction import Transaction
+from contextlib import contextmanager
+from itertools import islice
+from topline.transaction import Transaction, TransactionBatch, get_type
+from topline.importer import read_statement
+from topline.metrics import metrics
+from topline import MONTHS
 
 logger = logging.getLogger(__name__)
 
+# contrib_month is stored as the capitalised month name
+MONTH_NAMES = {month: MONTHS[month][0].capitalize() for month in MONTHS}
+MONTH_IDS = {name: month for month, name in MONTH_NAMES.items()}
+
+
+class ConnectionManager:
+    """Opens SQLite connections to a database file with the same journal mode and pragmas.
+
+    In WAL mode, read-only reader connections see the last committed state of
+    the database and can run reports while another connection is writing,
+    without "database is locked" errors. synchronous NORMAL is safe in WAL
+    mode and avoids a sync on every commit.
+
+    Attributes:
+        filename: The database file.
+        pragmas: Dict of pragma name to value, run on every new connection.
+        timeout: Seconds to wait for a lock held by another connection.
+    """
+
+    journal_modes = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    synchronous_modes = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, filename, journal_mode='WAL', synchronous='NORMAL', cache_size=-16000, mmap_size=268435456,
+                 timeout=30, cached_statements=256):
+        if str(journal_mode).upper() not in self.journal_modes:
+            raise ValueError("Invalid journal_mode: {}".format(journal_mode))
+        if str(synchronous).upper() not in self.synchronous_modes:
+            raise ValueError("Invalid synchronous: {}".format(synchronous))
+        self.filename = filename
+        self.journal_mode = str(journal_mode).upper()
+        # pragma values can't be bound as parameters, so they are validated above and here
+        self.pragmas = {'synchronous': str(synchronous).upper(),
+                        'cache_size': int(cache_size),
+                        'mmap_size': int(mmap_size)}
+        self.timeout = float(timeout)
+        self.cached_statements = int(cached_statements)
+
+    def connect(self, readonly=False):
+        """Opens a new connection with the configured pragmas.
+
+        The journal mode is stored in the database file, so it is only set by
+        writable connections. Read-only connections can't create the database.
+        """
+        uri = '{}?mode=ro'.format(Path(self.filename).absolute().as_uri()) if readonly else self.filename
+        # pipeline stages use the writer connection from worker threads, one stage at a time
+        connection = sqlite3.connect(uri, detect_types=sqlite3.PARSE_DECLTYPES, timeout=self.timeout,
+                                     cached_statements=self.cached_statements, check_same_thread=False,
+                                     uri=readonly)
+        if not readonly:
+            mode = connection.execute("PRAGMA journal_mode = {}".format(self.journal_mode)).fetchone()[0]
+            if mode.upper() != self.journal_mode:
+                logger.warning("Unable to set journal mode %s. Using %s", self.journal_mode, mode)
+        for name, value in self.pragmas.items():
+            connection.execute("PRAGMA {} = {}".format(name, value))
+        if metrics.enabled:
+            connection.set_trace_callback(DB.count_statement)
+        return connection
+
+    @contextmanager
+    def reader(self):
+        """Context manager giving a read-only connection that is closed on exit."""
+        connection = self.connect(readonly=True)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
 
 class DB:
-    def __init__(self, filename='topline.db', user_file=None, transaction_file=None):
+    def __init__(self, filename='topline.db', user_file=None, transaction_file=None, **options):
+        """Connects to the database, creating it from the user file if it does not exist.
+
+        Keyword arguments are passed to ConnectionManager, for example journal_mode='WAL' or cache_size=-16000.
+        """
         self.filename = filename
+        self.manager = ConnectionManager(filename, **options)
+        self.transaction_depth = 0
         if not Path(filename).is_file() and not user_file:
             logger.error('Database and User file not found. Unable to create database')
             self.connection = None
         else:
             logger.info("Connecting to database %s", self.filename)
-            self.connection = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES)
+            self.connection = self.manager.connect()
             self.cursor = self.connection.cursor()
             self.tables = self.get_tables()
             if ('users' not in self.tables or not self.get_usernames()) and not user_file:
@@ -25,6 +102,39 @@ class DB:
             else:
                 self.initialise_db(user_file, transaction_file)
 
+    @staticmethod
+    def count_statement(statement):
+        # trace callback counting every SQL statement run, by statement type
+        metrics.count('db_statements_total', statement=statement.split(None, 1)[0].upper())
+
+    @contextmanager
+    def transaction(self):
+        """Context manager running everything in the with block in one SQLite transaction.
+
+        The transaction is committed when the outermost block exits and rolled back if it raises. Methods that
+        commit on their own do not commit inside the block, so several calls can be grouped into one commit.
+        """
+        self.transaction_depth += 1
+        try:
+            yield self.cursor
+        except BaseException:
+            self.transaction_depth -= 1
+            if not self.transaction_depth:
+                self.connection.rollback()
+            raise
+        self.transaction_depth -= 1
+        if not self.transaction_depth:
+            self.connection.commit()
+
+    def commit(self):
+        # commit unless inside a DB.transaction block, which commits when it exits
+        if not self.transaction_depth:
+            self.connection.commit()
+
+    def reader(self):
+        """Returns a context manager giving a separate read-only connection, for reports run during an ingest."""
+        return self.manager.reader()
+
     def initialise_db(self, user_file=None, transactions_file=None):
         logger.info("Initialising database tables")
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS users(
@@ -41,7 +151,7 @@ class DB:
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS accounts(
                                             acc_num INTEGER PRIMARY KEY,
                                             name TEXT NOT NULL,
-                                            balance REAL
+                                            balance REAL,
                                             active INTEGER NOT NULL)
                             ''')
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS transactions(
@@ -58,15 +168,47 @@ class DB:
         self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS unique_transaction 
                                             ON transactions(acc_num, date, description, reference, amount)
                             ''')
-        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS calc_share AFTER UPDATE OF total ON users
-                               BEGIN
-                                    UPDATE users
-                                    SET share = (total / (SELECT SUM(total) FROM users WHERE username <> 'TIG') * 100) 
-                                    WHERE username <> 'TIG';
-                               END
+        # per member and month lookups. Includes amount so contribution totals are read from the index alone.
+        # unique_transaction already indexes (acc_num, date) as its leading columns
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS transactions_user_month
+                                            ON transactions(user_id, contrib_year, contrib_month, amount)
+                            ''')
+        # totals per month, account, member and transaction type. Kept up to date by ingest_transactions and
+        # rebuilt from the transactions table by rebuild_monthly_summary. Contributions are counted in the month
+        # they are for, other transactions in the month of their date
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS monthly_summary(
+                                            year INTEGER NOT NULL,
+                                            month INTEGER NOT NULL,
+                                            acc_num INTEGER NOT NULL,
+                                            user_id INTEGER NOT NULL,
+                                            type TEXT NOT NULL,
+                                            total REAL NOT NULL,
+                                            count INTEGER NOT NULL,
+                                            PRIMARY KEY (year, month, acc_num, user_id, type))
+                            ''')
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS outbox(
+                                            id INTEGER PRIMARY KEY,
+                                            idempotency_key TEXT UNIQUE NOT NULL,
+                                            recipient TEXT NOT NULL,
+                                            subject TEXT NOT NULL,
+                                            body TEXT NOT NULL,
+                                            attachment TEXT,
+                                            status TEXT NOT NULL DEFAULT 'queued',
+                                            attempts INTEGER NOT NULL DEFAULT 0,
+                                            message_id TEXT,
+                                            updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
                             ''')
+        if 'active' not in [column[1] for column in self.cursor.execute("PRAGMA table_info(accounts)")]:
+            # databases created before the column definition was fixed have no active column
+            logger.info("Adding active column to accounts table")
+            self.cursor.execute("ALTER TABLE accounts ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+        # shares are recalculated once per update by update_shares. Drop the old per row trigger
+        self.cursor.execute("DROP TRIGGER IF EXISTS calc_share")
 
-        self.connection.commit()
+        self.commit()
+        if 'monthly_summary' not in self.tables and 'transactions' in self.tables:
+            # database created before the monthly summary was added
+            self.rebuild_monthly_summary()
         if user_file:
             self.initialise_users(user_file)
         if transactions_file:
@@ -99,7 +241,7 @@ class DB:
                     (value['firstName'], value['lastName'], value['email'], key, key2))
             except sqlite3.IntegrityError:
                 logger.warning("User %s %s already in database", value['firstName'], value['lastName'])
-        self.connection.commit()
+        self.commit()
 
     def initialise_transactions(self, filename):
         logger.info("Initialising transactions table")
@@ -107,34 +249,49 @@ class DB:
             logger.warning('Transaction history file not found: %s. Unable to initialise transactions table',
                            Path(filename).absolute())
         else:
-            transactions = self.get_transactions_from_csv(filename)
-            logger.info("Read %s transactions from file", len(transactions))
-            count = 0
-            Transaction.usernames = self.get_usernames()
-            Transaction.accounts = self.get_accounts()
-            for trans in transactions:
-                logger.debug("Processing transaction %s/%s: date = %s, desc = %s, ref = %s, amount = %s.",
-                             count + 1, len(transactions), trans[0][0], trans[0][1], trans[0][2], trans[0][4])
-                t = Transaction(trans[0], trans[1])
-                if self.check_transaction(t.account, t.date, t.description, t.reference, t.amount):
-                    continue
-                contrib = t.process_transaction()
-                t.transaction_id = self.add_transaction(t.account, t.date, t.description, t.reference, t.amount,
-                                                        t.user_id, t.month, t.year)
-                if contrib and t.transaction_id:
-                    self.update_user(t.user_id, t.username, t.date, t.amount, t.transaction_id)
-                count += 1
-            logger.info("Processed %s/%s transactions in %s.", count, len(transactions), filename)
+            self.import_statement(filename)
 
-    @staticmethod
-    def get_transactions_from_csv(filename):
-        logger.info("Reading transactions from %s file", filename)
-        transactions = []
-        with open(filename, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                transactions.append([[row[0].replace('-', ' '), row[1], row[2], '', row[3], row[4]], int(row[5])])
-        return transactions
+    def import_statement(self, filename, account=None, chunk_size=1000):
+        """Streams transactions from a statement or transaction history file into the database.
+
+        The file is read with topline.importer.read_statement and added in batches of chunk_size transactions,
+        so memory use does not depend on the size of the file. Transactions are classified by the name of their
+        account, so transactions of accounts that are not in the accounts table are logged and skipped.
+
+        Args:
+            filename: An FNB CSV or OFX statement, or a transaction history CSV file.
+            account: Optional. The account number, if it is not in the file.
+            chunk_size: Optional. The number of transactions added per batch.
+
+        Returns:
+            The number of transactions added to the database.
+        """
+        Transaction.usernames = self.get_usernames()
+        Transaction.accounts = self.get_accounts()
+        accounts = [acc[0] for acc in Transaction.accounts]
+        skipped = {}
+        statement = read_statement(filename, account)
+        count = 0
+        added = 0
+        while True:
+            chunk = list(islice(statement, chunk_size))
+            if not chunk:
+                break
+            count += len(chunk)
+            for _, acc_num in chunk:
+                if acc_num not in accounts:
+                    if acc_num not in skipped:
+                        logger.error("Account %s is not in the database. Add the account before importing its "
+                                     "transactions", acc_num)
+                    skipped[acc_num] = skipped.get(acc_num, 0) + 1
+            if skipped:
+                chunk = [pair for pair in chunk if pair[1] in accounts]
+            if chunk:
+                added += len(self.ingest_transactions(TransactionBatch(chunk)))
+        for acc_num, skipped_count in skipped.items():
+            logger.warning("Skipped %s transactions of account %s in %s", skipped_count, acc_num, filename)
+        logger.info("Processed %s/%s transactions in %s.", added, count, filename)
+        return added
 
     def get_usernames(self):
         logger.debug("Fetching usernames from database")
@@ -158,19 +315,31 @@ class DB:
         logger.info("Fetched %s users from database", len(user_list))
         return user_list
 
-    def update_user(self, user_id, username, date, amount, transaction_id):
-        result = self.cursor.execute("SELECT total FROM users WHERE id = ?", (user_id,))
-        total = result.fetchone()[0] or 0
-        share = None
-        logger.info("Updating user %s: R %.2f received on %s, total: R %.2f -> R %.2f",
-                    username, amount, date, total, total + amount)
-        self.cursor.execute('''UPDATE users 
-                               SET last_transaction_id = ?,
-                                   total = ?,
-                                   share = ?
-                               WHERE id = ?''',
-                            (transaction_id, total + amount, share, user_id))
-        self.connection.commit()
+    def update_shares(self):
+        # share of the group total for every member. TIG is excluded from the group total
+        self.cursor.execute('''UPDATE users
+                               SET share = total / (SELECT SUM(total) FROM users WHERE username <> 'TIG') * 100
+                               WHERE username <> 'TIG'
+                            ''')
+
+    def recompute_totals(self):
+        """Rebuild user totals, last transactions and shares from the transactions table.
+
+        Reads every transaction once with a single aggregate query. Use to correct totals that no longer match
+        the transactions table.
+        """
+        logger.info("Recomputing user totals from transactions")
+        result = self.cursor.execute('''SELECT user_id, SUM(amount), MAX(id)
+                                        FROM transactions
+                                        WHERE user_id IS NOT NULL
+                                        GROUP BY user_id''')
+        totals = result.fetchall()
+        with self.transaction():
+            self.cursor.execute("UPDATE users SET total = NULL, last_transaction_id = NULL")
+            self.cursor.executemany("UPDATE users SET total = ?, last_transaction_id = ? WHERE id = ?",
+                                    [(total, last_id, user_id) for user_id, total, last_id in totals])
+            self.update_shares()
+        logger.info("Recomputed totals for %s users", len(totals))
 
     def get_accounts(self):
         logger.debug("Fetching accounts from database")
@@ -179,11 +348,16 @@ class DB:
         logger.info("Fetched %s accounts from database", len(accounts))
         return accounts
 
+    def get_account_balances(self):
+        """Returns (acc_num, balance, active) for every account, ordered by account number."""
+        result = self.cursor.execute("SELECT acc_num, balance, active FROM accounts ORDER BY acc_num")
+        return result.fetchall()
+
     def add_account(self, acc_num, name, balance, active=True):
         logger.info("Adding account to database: %s - %s, balance = R %.2f", acc_num, name, float(balance))
         self.cursor.execute("INSERT INTO accounts (acc_num, name, balance, active) VALUES (?,?,?,?)",
                             (acc_num, name, balance, active))
-        self.connection.commit()
+        self.commit()
 
     def update_account(self, acc_num, name, balance):
         result = self.cursor.execute("SELECT balance FROM accounts WHERE acc_num = ?", (acc_num,))
@@ -195,7 +369,7 @@ class DB:
             logger.info("Updating balance: %s - %s, R %.2f -> R %.2f", acc_num, name, current_balance, balance)
             self.cursor.execute("UPDATE accounts SET balance = ? WHERE acc_num = ?",
                                 (float(balance), acc_num,))
-            self.connection.commit()
+            self.commit()
         else:
             logger.debug("Account %s - %s up to date", acc_num, name)
 
@@ -204,37 +378,306 @@ class DB:
         account = result.fetchone()
         logger.info("Setting account status to inactive: %s - %s, balance = %.2f", account[0], account[1], account[2])
         self.cursor.execute("UPDATE accounts SET balance = ?, active = ? WHERE acc_num = ?", (0, False,))
-        self.connection.commit()
+        self.commit()
 
-    def add_transaction(self, acc_num, date, description, reference, amount, user_id, month=None, year=None):
-        try:
-            logger.debug("Adding transaction to database")
-            self.cursor.execute('''INSERT INTO transactions (
-                                        acc_num, date, description, reference, amount, 
-                                        user_id, contrib_month, contrib_year)
-                                   VALUES (?,?,?,?,?,?,?,?)''',
-                                (acc_num, date, description, reference, amount, user_id, month, year))
-            self.connection.commit()
-        except sqlite3.IntegrityError:
-            logger.debug("Transaction already in database")
-            return False
-        return self.cursor.lastrowid
+    @metrics.timed('db_ingest_seconds')
+    def ingest_transactions(self, transactions):
+        """Add a batch of transactions to the database in a single SQLite transaction.
+
+        Transactions already in the database are skipped by the unique_transaction index. User totals are
+        updated once for the whole batch instead of once per transaction.
+
+        Args:
+            transactions: A topline.transaction.TransactionBatch or an iterable of
+                topline.transaction.Transaction instances. Unprocessed transactions are processed before being
+                added.
+
+        Returns:
+            A list of the transactions that were added, in the order given, with transaction_id set. For a
+            TransactionBatch, a list of the indices of the rows that were added.
+        """
+        batch = isinstance(transactions, TransactionBatch)
+        if not batch:
+            transactions = list(transactions)
+        added = []
+        with self.transaction():
+            result = self.cursor.execute("SELECT COALESCE(MAX(id), 0) FROM transactions")
+            last_id = result.fetchone()[0]
+            rows = transactions.rows() if batch else (t.row() for t in transactions)
+            for i, row in enumerate(rows):
+                self.cursor.execute('''INSERT OR IGNORE INTO transactions (
+                                            acc_num, date, description, reference, amount,
+                                            user_id, contrib_month, contrib_year)
+                                       VALUES (?,?,?,?,?,?,?,?)''', row)
+                if self.cursor.rowcount == 1:
+                    if batch:
+                        transactions.transaction_id[i] = self.cursor.lastrowid
+                        added.append(i)
+                    else:
+                        transactions[i].transaction_id = self.cursor.lastrowid
+                        added.append(transactions[i])
+            logger.info("Added %s new transactions to database", len(added))
+            metrics.count('db_transactions_added_total', len(added))
+            if added:
+                self.update_users_from(last_id)
+                if batch:
+                    self.update_monthly_summary(
+                        (transactions.year[i], transactions.month_id[i], transactions.account[i],
+                         transactions.user_id[i], transactions.get_type(i), transactions.amount[i]) for i in added)
+                else:
+                    self.update_monthly_summary((t.year, t.month_id, t.account, t.user_id, t.type, t.amount)
+                                                for t in added)
+        return added
+
+    def update_monthly_summary(self, transactions):
+        # add (year, month, acc_num, user_id, type, amount) tuples to the monthly summary totals
+        totals = {}
+        for year, month, acc_num, user_id, transaction_type, amount in transactions:
+            key = (year, month, acc_num, user_id or 0, transaction_type or 'unknown')
+            total, count = totals.get(key, (0, 0))
+            totals[key] = (total + amount, count + 1)
+        self.cursor.executemany('''INSERT INTO monthly_summary (year, month, acc_num, user_id, type, total, count)
+                                   VALUES (?,?,?,?,?,?,?)
+                                   ON CONFLICT (year, month, acc_num, user_id, type)
+                                   DO UPDATE SET total = total + excluded.total, count = count + excluded.count''',
+                                [key + value for key, value in totals.items()])
+        logger.debug("Updated %s monthly summary rows", len(totals))
+
+    def rebuild_monthly_summary(self):
+        """Recreates the monthly summary table from the transactions table and returns the number of rows."""
+        logger.info("Rebuilding monthly summary from transactions")
+        # transaction types depend on the account, member, description and the sign of the amount, so
+        # transactions are grouped on those and each group is classified once
+        result = self.cursor.execute('''SELECT t.contrib_year, t.contrib_month, CAST(strftime('%m', t.date) AS INTEGER),
+                                               t.acc_num, t.user_id, a.name, u.username, t.description,
+                                               (t.amount > 0) - (t.amount < 0), SUM(t.amount), COUNT(*)
+                                        FROM transactions t
+                                        LEFT JOIN accounts a ON a.acc_num = t.acc_num
+                                        LEFT JOIN users u ON u.id = t.user_id
+                                        GROUP BY 1, 2, 3, 4, 5, 8, 9''')
+        totals = {}
+        for year, contrib_month, month, acc_num, user_id, name, username, description, sign, amount, count in result:
+            transaction_type = get_type(name or '', username, description or '', sign) or 'unknown'
+            key = (year, MONTH_IDS[contrib_month] if contrib_month else month, acc_num, user_id or 0,
+                   transaction_type)
+            total, n = totals.get(key, (0, 0))
+            totals[key] = (total + amount, n + count)
+        with self.transaction():
+            self.cursor.execute("DELETE FROM monthly_summary")
+            self.cursor.executemany('''INSERT INTO monthly_summary (year, month, acc_num, user_id, type, total, count)
+                                       VALUES (?,?,?,?,?,?,?)''', [key + value for key, value in totals.items()])
+        logger.info("Rebuilt monthly summary with %s rows", len(totals))
+        return len(totals)
+
+    def get_monthly_summary(self, year=None, month=None):
+        """Returns (year, month, acc_num, user_id, type, total, count) rows of the monthly summary.
+
+        Args:
+            year: Optional. Only return rows for this year.
+            month: Optional. Only return rows for this month.
+        """
+        with self.reader() as connection:
+            result = connection.execute('''SELECT year, month, acc_num, user_id, type, total, count
+                                           FROM monthly_summary
+                                           WHERE (:year IS NULL OR year = :year) AND (:month IS NULL OR month = :month)
+                                           ORDER BY year, month, acc_num, type, user_id''',
+                                        {'year': year, 'month': month})
+            return result.fetchall()
+
+    def update_users_from(self, last_id):
+        # add all transactions with an id greater than last_id to the user totals in one statement
+        self.cursor.execute('''UPDATE users
+                               SET last_transaction_id = (SELECT MAX(t.id) FROM transactions t
+                                                          WHERE t.user_id = users.id AND t.id > :last_id),
+                                   total = COALESCE(total, 0) + (SELECT SUM(t.amount) FROM transactions t
+                                                                 WHERE t.user_id = users.id AND t.id > :last_id)
+                               WHERE id IN (SELECT user_id FROM transactions WHERE id > :last_id)''',
+                            {'last_id': last_id})
+        logger.info("Updated totals for %s users", self.cursor.rowcount)
+        self.update_shares()
+
+    def get_contribution_matrix(self, start, end):
+        """Returns the contributions of every member for each month in a range.
+
+        Totals are read from the monthly summary through a read-only connection, so it can be called while
+        transactions are being added.
+
+        Args:
+            start: The first (year, month) of the range.
+            end: The last (year, month) of the range.
+
+        Returns:
+            A (months, rows) tuple. months is the list of (year, month) in the range. rows is a list with a
+            (user_id, username, amounts) tuple for each member except TIG, where amounts is a list of the total
+            contributed for each month, 0 if nothing was paid.
+        """
+        months = []
+        year, month = start
+        while (year, month) <= tuple(end):
+            months.append((year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        columns = {month: i for i, month in enumerate(months)}
+        with self.reader() as connection:
+            users = connection.execute("SELECT id, username FROM users WHERE username <> 'TIG' ORDER BY id").fetchall()
+            result = connection.execute('''SELECT user_id, year, month, SUM(total)
+                                           FROM monthly_summary
+                                           WHERE type = 'contribution' AND year BETWEEN ? AND ?
+                                           GROUP BY user_id, year, month''',
+                                        (start[0], end[0]))
+            rows = {user_id: (user_id, username, [0] * len(months)) for user_id, username in users}
+            for user_id, year, month, total in result:
+                column = columns.get((year, month))
+                if column is not None and user_id in rows:
+                    rows[user_id][2][column] = total
+        logger.info("Fetched contributions of %s members for %s months", len(rows), len(months))
+        return months, list(rows.values())
+
+    def get_arrears(self, year, month):
+        """Returns the id, name, surname, email and username of every member with no contribution for a month."""
+        with self.reader() as connection:
+            result = connection.execute('''SELECT id, name, surname, email, username
+                                           FROM users u
+                                           WHERE username <> 'TIG' AND NOT EXISTS (
+                                               SELECT 1 FROM monthly_summary s
+                                               WHERE s.user_id = u.id AND s.year = ? AND s.month = ? AND
+                                                     s.type = 'contribution')
+                                           ORDER BY id''', (year, month))
+            users = result.fetchall()
+        logger.info("%s members have not contributed for %s %s", len(users), MONTH_NAMES[month], year)
+        return users
+
+    def get_yearly_totals(self, year=None):
+        """Returns (user_id, username, year, total) for every member and year they contributed in.
 
-    def check_transaction(self, acc_num, date, description, reference, amount):
-        result = self.cursor.execute('''SELECT rowid
+        Args:
+            year: Optional. Only return totals for this year.
+        """
+        with self.reader() as connection:
+            result = connection.execute('''SELECT s.user_id, u.username, s.year, SUM(s.total)
+                                           FROM monthly_summary s
+                                           JOIN users u ON u.id = s.user_id
+                                           WHERE s.type = 'contribution' AND (:year IS NULL OR s.year = :year)
+                                           GROUP BY s.user_id, s.year
+                                           ORDER BY s.user_id, s.year''', {'year': year})
+            totals = result.fetchall()
+        return totals
+
+    def get_sheet_transactions(self):
+        """Yields every transaction with the tracking sheet period and type it is written to.
+
+        Rows are read from a reader connection one at a time, ordered by the month and then by id, which is the
+        order they were added to the workbook.
+
+        Yields:
+            (id, year, month, acc_num, username, type, description, reference, amount) tuples, where year and
+            month are the contribution period for contributions and the transaction date otherwise.
+        """
+        month = "CASE t.contrib_month {} ELSE CAST(strftime('%m', t.date) AS INTEGER) END".format(
+            ' '.join("WHEN '{}' THEN {}".format(name, month_id) for month_id, name in MONTH_NAMES.items()))
+        with self.reader() as connection:
+            result = connection.execute('''SELECT t.id, t.contrib_year, {month}, t.acc_num, a.name, u.username,
+                                                  t.description, t.reference, t.amount
+                                           FROM transactions t
+                                           LEFT JOIN accounts a ON a.acc_num = t.acc_num
+                                           LEFT JOIN users u ON u.id = t.user_id
+                                           ORDER BY t.contrib_year * 12 + {month}, t.id'''.format(month=month))
+            for transaction_id, year, month_id, acc_num, name, username, description, reference, amount in result:
+                transaction_type = get_type(name or '', username, description or '', amount)
+                yield (transaction_id, year, month_id, acc_num, username, transaction_type, description, reference,
+                       amount)
+
+    def get_high_water_mark(self, acc_num):
+        """Returns the latest transaction date of an account and the transactions on that date.
+
+        Transactions are returned as a set of (description, reference, amount) tuples. Returns None if the
+        account has no transactions.
+        """
+        result = self.cursor.execute('''SELECT date, description, reference, amount
                                         FROM transactions
                                         WHERE acc_num = ? AND
-                                              date = ? AND
-                                              description = ? AND
-                                              reference = ? AND
-                                              amount = ?''',
-                                     (acc_num, date, description, reference, amount))
-        if not result.fetchone():
-            logger.debug("Transaction not in database")
-            return False
-        else:
-            logger.debug("Transaction already in database")
+                                              date = (SELECT MAX(date) FROM transactions WHERE acc_num = ?)''',
+                                     (acc_num, acc_num))
+        rows = result.fetchall()
+        if not rows:
+            return None
+        logger.debug("Account %s high water mark: %s, %s transactions", acc_num, rows[0][0], len(rows))
+        return rows[0][0], {row[1:] for row in rows}
+
+    def get_transactions(self, transaction_ids):
+        """Returns processed topline.transaction.Transaction instances for a list of transaction ids.
+
+        Uses Transaction.usernames and Transaction.accounts, which must be set before calling.
+        """
+        transactions = []
+        ids = iter(transaction_ids)
+        # query in chunks to stay below the SQLite limit on the number of parameters
+        for chunk in iter(lambda: list(islice(ids, 500)), []):
+            result = self.cursor.execute('''SELECT id, acc_num, date, description, reference, amount
+                                            FROM transactions
+                                            WHERE id IN ({})'''.format(','.join('?' * len(chunk))), chunk)
+            for row in result.fetchall():
+                t = Transaction((row[2].strftime('%d %b %Y'), row[3], row[4], '', str(row[5])), row[1])
+                t.transaction_id = row[0]
+                t.process_transaction()
+                transactions.append(t)
+        transactions.sort(key=lambda t: t.transaction_id)
+        return transactions
+
+    def queue_email(self, key, recipient, subject, body, attachment=None):
+        """Adds an email to the outbox unless an email with the same idempotency key has already been queued.
+
+        Returns:
+            True if the email was queued. False if the key is already in the outbox.
+        """
+        self.cursor.execute('''INSERT OR IGNORE INTO outbox (idempotency_key, recipient, subject, body, attachment)
+                               VALUES (?,?,?,?,?)''',
+                            (key, recipient, subject, body, attachment and str(attachment)))
+        self.commit()
+        if self.cursor.rowcount == 1:
+            logger.debug("Queued email %s to %s", key, recipient)
             return True
+        logger.debug("Email %s already in outbox", key)
+        return False
+
+    def get_pending_emails(self):
+        """Returns the id, recipient, subject, body and attachment of every queued or failed email."""
+        result = self.cursor.execute('''SELECT id, recipient, subject, body, attachment
+                                        FROM outbox
+                                        WHERE status IN ('queued', 'failed')
+                                        ORDER BY id''')
+        emails = result.fetchall()
+        logger.info("Fetched %s pending emails from outbox", len(emails))
+        interrupted = self.cursor.execute("SELECT id FROM outbox WHERE status = 'sending'").fetchall()
+        if interrupted:
+            logger.warning("Emails %s were interrupted while sending and may have been delivered. Check them and "
+                           "send them again with --requeue-interrupted", ', '.join(str(i[0]) for i in interrupted))
+        return emails
+
+    def mark_email_sending(self, email_id):
+        """Marks an outbox email as being sent, so it is not sent again if the run is interrupted."""
+        self.cursor.execute('''UPDATE outbox SET status = 'sending', updated = CURRENT_TIMESTAMP WHERE id = ?''',
+                            (email_id,))
+        self.commit()
+
+    def requeue_interrupted_emails(self):
+        """Marks emails left as sending by an interrupted run as queued again. Returns the number requeued."""
+        self.cursor.execute('''UPDATE outbox SET status = 'queued', updated = CURRENT_TIMESTAMP
+                               WHERE status = 'sending' ''')
+        count = self.cursor.rowcount
+        self.commit()
+        logger.info("Requeued %s interrupted emails", count)
+        return count
+
+    def update_email(self, email_id, sent, message_id=None):
+        """Marks an outbox email as sent or failed and counts the attempt."""
+        self.cursor.execute('''UPDATE outbox
+                               SET status = ?,
+                                   message_id = ?,
+                                   attempts = attempts + 1,
+                                   updated = CURRENT_TIMESTAMP
+                               WHERE id = ?''',
+                            ('sent' if sent else 'failed', message_id, email_id))
+        self.commit()
 
     def close_db(self):
         logger.info("Closing database connection!")
@@ -2,9 +2,15 @@ import openpyxl
 import openpyxl.utils
 import openpyxl.comments
 import re
+import stat
+from datetime import datetime
+from itertools import groupby
 from pathlib import Path
 import logging
 from topline import MONTHS
+from topline.metrics import metrics
+from openpyxl.workbook.protection import WorkbookProtection
+from openpyxl.workbook.defined_name import DefinedNameList
 
 # imports for openpyxl merge patch
 from openpyxl.worksheet import Worksheet
@@ -47,6 +53,45 @@ def format_string(s):
     return string_list
 
 
+def get_sheet_range(sheet_name):
+    # return the [start month, start year, end month, end year] of a sheet from its name
+    # eg: "MAR 17 - FEB 18" -> [3, 17, 2, 18]
+    s = format_string(sheet_name)
+
+    # Iterate through the elements of the sheet name to determine
+    # the month and year range that the sheet is for
+    return [i if type(i) is int else (next((j for j, x in MONTHS.items() if i in x), None)) for i in s]
+
+
+def month_index(year, month):
+    # return the number of months from January of year 0 to a month, for comparing and subtracting months
+    # two digit years from sheet names are taken to be from 2000
+    return (year + 2000 if year < 100 else year) * 12 + month - 1
+
+
+def month_name(index):
+    # return the sheet name form of a month index from month_index
+    # eg: 24206 -> "MAR 17"
+    return '{} {:02d}'.format(MONTHS[index % 12 + 1][-1], index // 12 % 100)
+
+
+def format_headers(cells):
+    # return [month, year] for date header cells and the string value of other cells
+    return [[h.value.month, h.value.year % 2000] if h.is_date else str(h.value) for h in cells]
+
+
+def merge_cell(cell_val, cell_comment, value, comment=None):
+    # return the value and comment text of a cell after adding a value and comment to it
+    new_comment = 'R' + str(value) + ': ' + str(comment)
+    if cell_val == 0 or cell_val == '-' or cell_val is None:
+        return value, new_comment if comment else None
+
+    # Check if there is an existing comment and concatenate it with the
+    # new comment.
+    old_comment = cell_comment if cell_comment else 'R' + str(cell_val)
+    return cell_val + value, '\n + '.join(filter(None, (old_comment, new_comment)))
+
+
 def patch_worksheet():
     """This monkeypatches Worksheet.merge_cells to remove cell deletion bug
     https://bitbucket.org/openpyxl/openpyxl/issues/365/styling-merged-cells-isnt-working
@@ -73,6 +118,66 @@ def patch_worksheet():
 patch_worksheet()
 
 
+class ColumnSlots:
+    """Index of the labels and empty cells in a block of a worksheet column.
+
+    Built with one scan of the block and kept up to date by fill(), so
+    repeated writes to the same block don't rescan it. Labels are matched
+    exactly on their string value.
+
+    Attributes:
+        labels: A dict of cell value strings to row numbers.
+        free: A list of the rows of empty cells, in order.
+    """
+
+    def __init__(self, sheet, col, start_row, end_row):
+        self.labels = {}
+        self.free = []
+        for row in range(start_row, end_row + 1):
+            value = sheet.cell(row=row, column=col).value
+            if value is None:
+                self.free.append(row)
+            else:
+                self.labels.setdefault(str(value), row)
+
+    def find(self, label):
+        """Returns the row containing label, None if not found."""
+        return self.labels.get(str(label))
+
+    def next_free(self):
+        """Returns the first empty row, None if the block is full."""
+        return self.free[0] if self.free else None
+
+    def fill(self, row, label=None):
+        """Marks a row as no longer empty, optionally recording its label."""
+        self.free.remove(row)
+        if label is not None:
+            self.labels.setdefault(str(label), row)
+
+
+class WritePlan:
+    """Staged cell writes, grouped by cell.
+
+    Values and comments added to the same cell are kept together so that
+    each cell is written, and its comment built, once when the plan is
+    applied.
+
+    Attributes:
+        cells: A dict of (sheet name, row, column) to a list of
+            (value, comment) tuples, in the order they were added.
+    """
+
+    def __init__(self):
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def add(self, sheet_name, row, col, value, comment=None):
+        """Stages a value and comment to be added to a cell."""
+        self.cells.setdefault((sheet_name, row, col), []).append((value, comment))
+
+
 class Excel:
     """Class to interface with an Excel workbook
     
@@ -90,10 +195,14 @@ class Excel:
         self.sheet_names = None
         self.sheet_list = []
         self.header_list = []
+        self.columns = {}
+        self.slots = {}
+        self.plan = WritePlan()
         self.summary_sheet = None
         self.workbook = None
         try:
-            self.workbook = openpyxl.load_workbook(filename)
+            with metrics.timer('excel_load_seconds'):
+                self.workbook = openpyxl.load_workbook(filename)
             self.get_sheets()
         except FileNotFoundError:
             logger.error("File not found: %s", Path(filename).absolute())
@@ -108,75 +217,95 @@ class Excel:
             r[2].value = 0
 
     def add_transaction(self, transaction):
-        """Processes a transaction and writes it to the excel workbook.
+        """Processes a transaction and stages it to be written to the excel workbook.
         
         Determines the correct sheet, row and column in the workbook that the 
-        transaction belongs to and then attempts to write the transaction to 
-        the cell depending on the transaction type.
+        transaction belongs to and then stages the transaction to be added to 
+        the cell depending on the transaction type. Staged transactions are 
+        written by apply_plan when the workbook is closed.
         
         Args:
             transaction: An instance of topline.transaction.Transaction class
         
         Returns:
-            True if the transaction is successfully written to the sheet.
+            True if the transaction is successfully staged.
             False otherwise.
         """
                 
-        # determine which sheet to use for current transaction
-        sheet = self.get_target_sheet(transaction.month_id, transaction.year % 2000)
+        # determine which sheet and column to use for current transaction
+        sheet, column = self.get_column(transaction.month_id, transaction.year % 2000)
         if not sheet:
-            logger.warning("Error finding correct sheet for transaction. Month = %s, Year = %s",
-                           transaction.month_id, transaction.year % 2000)
-            return False
-        header = self.get_column_headers(sheet)
-
-        # find correct column for contribution month
-        try:
-            column = header.index([transaction.month_id, transaction.year % 2000]) + 1
-        except ValueError:
-            logger.warning("Error finding correct column: Month %s, Year %s",
+            logger.warning("Error finding correct sheet and column for transaction. Month = %s, Year = %s",
                            transaction.month_id, transaction.year % 2000)
             return False
 
         comment = None
+        slots = None
         
         # Find correct row in worksheet based on transaction type
         if transaction.type == 'contribution':
             user_offset = [ui for ui, u in enumerate(Excel.user_ids) if u[1] == transaction.username]
             row = user_row + user_offset[0]
         elif transaction.type == 'roi':
-            cell = self.find_in_column(transaction.account, sheet, 1, roi_row, last_roi_row)
-            if not cell:
-                cell = self.find_in_column(None, sheet, 1, roi_row, last_roi_row)
-                cell.value = transaction.account
-            row = cell.row
+            row = self.get_label_row(transaction.account, sheet, 1, roi_row, last_roi_row)
         elif transaction.type == 'income':
-            cell = self.find_in_column(None, sheet, column, income_row, last_income_row)
-            row = cell.row
+            slots = self.get_slots(sheet, column, income_row, last_income_row)
+            row = slots.next_free()
             comment = transaction.description + ' - ' + transaction.reference
         elif transaction.type == 'expense':
             if 'MONTHLY ACCOUNT FEE' in transaction.description.upper():
                 row = expense_row
             else:
-                cell = self.find_in_column(None, sheet, column, expense_row + 1, last_expense_row)
-                row = cell.row
+                slots = self.get_slots(sheet, column, expense_row + 1, last_expense_row)
+                row = slots.next_free()
                 comment = transaction.description + ' - ' + transaction.reference
         else:
             return False
-        return self.write_to_sheet(sheet, row, column, abs(transaction.amount), add=True, comment=comment)
+        if row is None:
+            logger.warning("[%s] No free row for %s in column %s!",
+                           sheet.title, transaction.type, openpyxl.utils.get_column_letter(column))
+            return False
+        if not self.stage_write(sheet, row, column, abs(transaction.amount), comment=comment):
+            return False
+        if slots:
+            slots.fill(row)
+        metrics.count('excel_transactions_total', type=transaction.type)
+        return True
 
     def update_account_balances(self, account, balance):
         """Finds account number on the summary sheet and updates its balance"""
         sheet = self.summary_sheet
-        cell = self.find_in_column(account, sheet, col=1, start_row=account_row, end_row=last_account_row)
-        if cell:
-            logger.info("Updating account %s balance: R %.2f", account, balance)
-            sheet.cell(row=cell.row, column=3).value = balance
-        else:
-            logger.info("Adding account %s balance: R %.2f", account, balance)
-            new_cell = self.find_in_column(None, sheet, col=1, start_row=account_row, end_row=last_account_row)
-            new_cell.value = account
-            sheet.cell(row=new_cell.row, column=3).value = balance
+        row = self.get_label_row(account, sheet, 1, account_row, last_account_row)
+        if row is None:
+            logger.warning("No free row to add account %s balance: R %.2f", account, balance)
+            return
+        logger.info("Updating account %s balance: R %.2f", account, balance)
+        sheet.cell(row=row, column=3).value = balance
+
+    def get_slots(self, sheet, col, start_row, end_row):
+        """Returns the ColumnSlots for a block of a sheet column, scanning the block on first use."""
+        key = (sheet.title, col, start_row, end_row)
+        if key not in self.slots:
+            self.slots[key] = ColumnSlots(sheet, col, start_row, end_row)
+        return self.slots[key]
+
+    def get_label_row(self, label, sheet, col, start_row, end_row):
+        """Returns the row of a label in a block of a sheet column.
+
+        If the label is not found it is written to the first empty cell in
+        the block. Returns None if the label is not found and the block is
+        full.
+        """
+        slots = self.get_slots(sheet, col, start_row, end_row)
+        row = slots.find(label)
+        if row is None:
+            row = slots.next_free()
+            if row is None:
+                return None
+            logger.info("[%s] Adding %s to %s%s", sheet.title, label, openpyxl.utils.get_column_letter(col), row)
+            sheet.cell(row=row, column=col).value = label
+            slots.fill(row, label)
+        return row
 
     def get_sheets(self):
         """Creates a list of sheet names and a list of month and year indeces"""
@@ -185,20 +314,15 @@ class Excel:
             if 'summary' in sheet.lower():
                 self.summary_sheet = self.workbook[sheet]
             else:
-                # format sheet name
-                s = format_string(sheet)
-                
-                # Iterate through the elements of the sheet name to determine
-                # the month and year range that the sheet is for
-                name = [i if type(i) is int else (next((j for j, x in MONTHS.items() if i in x), None)) for i in s]
-                self.sheet_list.append(name)
+                self.sheet_list.append(get_sheet_range(sheet))
+                self.index_sheet(self.workbook[sheet])
         self.sheet_names.remove(self.summary_sheet.title)
 
     def get_user_ids(self):
         """Returns a list of usernames from the summary sheet."""
         row = 5
         user_ids = []
-        while row < self.summary_sheet.max_row:
+        while row <= self.summary_sheet.max_row:
             user_id = self.summary_sheet.cell(row=row, column=2).value
             if user_id is None:
                 break
@@ -209,73 +333,181 @@ class Excel:
 
     def get_column_headers(self, sheet):
         """Returns a list of month and year references from column headers."""
-        header = sheet[header_row]
-        header = [[h.value.month, h.value.year % 2000] if h.is_date else str(h.value) for h in header]
-        return header
-
-    def get_target_sheet(self, month, year):
-        """Return the sheet to use based on the transaction month and year."""
-        sheet_id = [i for i, s in enumerate(self.sheet_list) if
-                    (month >= s[0] and year == s[1]) or (month <= s[2] and year == s[3])]
-        if not sheet_id:
-            return None
-        return self.workbook[self.sheet_names[sheet_id[0]]]
-
-    def write_to_sheet(self, sheet, row, col, value, overwrite=False, add=False, comment=None):
-        """Writes a value to a cell in a worksheet.
-        
-        Writes the given value to the cell defined by the row and column
-        position in the given sheet, if the cell is not locked. If overwrite
-        is True, any value and comment in the cell is overwritten. If add is 
-        True, the value and comment are added to the existing value and comment.
-        
-        Args:
-            sheet: a Worksheet instance containing the cell to write to.
-            row: the row reference of the cell.
-            col: the column reference of the cell.
-            value: The value to write.
-            overwrite: Optional, Set to True to overwrite existing value and 
-                comment in the target cell.
-            add: Optional, Set to True to add to the existing value and comment
-                in the target cell.
-            comment: Optional. The comment to add to the cell.
-        
+        return format_headers(sheet[header_row])
+
+    def index_sheet(self, sheet):
+        """Adds the month columns of a sheet to the column index.
+
+        Must be called for every sheet added to the workbook. Where more than
+        one sheet has a column for a month, the first sheet indexed is used.
+        """
+        for column, h in enumerate(self.get_column_headers(sheet), 1):
+            if type(h) is list:
+                self.columns.setdefault(tuple(h), (sheet, column))
+
+    def get_column(self, month, year):
+        """Return the sheet and column for a month and year, (None, None) if not found."""
+        return self.columns.get((month, year), (None, None))
+
+    def stage_write(self, sheet, row, col, value, comment=None):
+        """Stages a value and comment to be added to a cell in a worksheet.
+
         Returns:
-            True if the value and comment were successfully written.
-            False otherwise.
+            True if the value was staged. False if the cell is locked.
         """
-        
-        target_cell = sheet.cell(row=row, column=col)
-        if target_cell.protection.locked:
+        if sheet.cell(row=row, column=col).protection.locked:
             logger.warning("[%s] %s%s is locked!", sheet.title, openpyxl.utils.get_column_letter(col), row)
             return False
-
-        new_comment = 'R' + str(value) + ': ' + str(comment)
-        cell_val = target_cell.value
-        if cell_val == 0 or cell_val == '-' or cell_val is None or overwrite:
-            target_cell.value = value
-            target_cell.comment = openpyxl.comments.Comment(new_comment, 'Topline') if comment else None
-            logger.info("Transaction written to sheet [%s] %s%s.",
-                        sheet.title, openpyxl.utils.get_column_letter(col), row)
-        elif add:
-            logger.info("[%s] %s%s contains data! Adding to existing value!",
-                        sheet.title, openpyxl.utils.get_column_letter(col), row)
-            target_cell.value = cell_val + value
-            
-            # Check if there is an existing comment and concatenate it with the
-            # new comment.
-            old_comment = target_cell.comment.text if target_cell.comment.text else 'R' + str(target_cell.value)
-            cell_comment = '\n + '.join(filter(None, (old_comment, new_comment)))
-            # cell_comment = cell_comment or (str(cell_val) + ' + ' + str(value))
-            target_cell.comment = openpyxl.comments.Comment(cell_comment, 'Topline') if cell_comment else None
-        else:
-            logger.warning("[%s] %s%s contains data! Transaction not written to sheet!",
-                           sheet.title, openpyxl.utils.get_column_letter(col), row)
-            return False
+        logger.debug("Transaction staged for sheet [%s] %s%s.", sheet.title,
+                     openpyxl.utils.get_column_letter(col), row)
+        self.plan.add(sheet.title, row, col, value, comment)
         return True
 
+    def resolve_plan(self):
+        """Yields the sheet, cell, new value and new comment text of each staged cell."""
+        for (sheet_name, row, col), writes in self.plan.cells.items():
+            sheet = self.workbook[sheet_name]
+            cell = sheet.cell(row=row, column=col)
+            value = cell.value
+            comment = cell.comment.text if cell.comment else None
+            for v, c in writes:
+                value, comment = merge_cell(value, comment, v, c)
+            yield sheet, cell, value, comment
+
+    def get_plan_diff(self):
+        """Returns a list of lines describing the staged changes to each cell."""
+        lines = []
+        for sheet, cell, value, comment in self.resolve_plan():
+            lines.append("[{}] {}: {} -> {}".format(sheet.title, cell.coordinate, cell.value, value))
+            if comment:
+                lines.extend('    ' + line for line in comment.splitlines())
+        return lines
+
+    def apply_plan(self):
+        """Writes all staged values and comments to the workbook and clears the plan."""
+        for sheet, cell, value, comment in self.resolve_plan():
+            cell.value = value
+            cell.comment = openpyxl.comments.Comment(comment, 'Topline') if comment else None
+            logger.info("Transaction written to sheet [%s] %s.", sheet.title, cell.coordinate)
+            metrics.count('excel_cells_written_total')
+        logger.info("Wrote %s staged cells to workbook", len(self.plan))
+        self.plan = WritePlan()
+
+    def archive_years(self, archive_dir, before):
+        """Moves closed year sheets out of the saved workbook into read only archive workbooks.
+
+        Must be called after close_workbook has saved the workbook to its
+        file, so transactions for a closed year are archived with it. The
+        saved file is loaded once. Each year sheet that ends before the month
+        of the before date is saved on its own to '<archive_dir>/<workbook
+        name> <sheet name>.xlsx' with the sheet and workbook structure
+        protected, and the file is made read only. The file is then saved
+        again with only the summary sheet and the open years, so it stays the
+        same size as the group ages.
+
+        A year whose archive file already exists is left in the workbook, as
+        is a year that formulas in the sheets left in the workbook refer to,
+        since those formulas would no longer resolve once it is removed.
+
+        Args:
+            archive_dir: The folder to write the archive workbooks to.
+            before: A date or datetime. Years ending before its month are archived.
+
+        Returns:
+            A list of the archive workbook file names written.
+        """
+        if len(self.plan):
+            logger.error("Workbook has %s staged writes. Save it with close_workbook before archiving", len(self.plan))
+            return []
+        closed = [name for name, (_, _, end_month, end_year) in zip(self.sheet_names, self.sheet_list)
+                  if (2000 + end_year, end_month) < (before.year, before.month)]
+        if not closed:
+            return []
+        archive_dir = Path(archive_dir)
+        paths = {name: archive_dir.joinpath('{} {}.xlsx'.format(Path(self.filename).stem, name)) for name in closed}
+        for name in closed:
+            if paths[name].exists():
+                logger.warning("Archive %s already exists. Keeping [%s] in the workbook", paths[name], name)
+        closed = [name for name in closed if not paths[name].exists()]
+        references = self.get_references(closed)
+        # a year kept in the workbook keeps the years its formulas refer to as well
+        while True:
+            referenced = [name for name in closed if any(title not in closed for title, _, _ in references[name])]
+            if not referenced:
+                break
+            for name in referenced:
+                for title, coordinate, formula in references[name]:
+                    logger.warning("[%s] %s refers to [%s]: %s", title, coordinate, name, formula)
+                logger.warning("Keeping [%s] in the workbook as %s formulas refer to it", name, len(references[name]))
+                closed.remove(name)
+        if not closed:
+            return []
+
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        archived = []
+        with metrics.timer('excel_archive_seconds'):
+            # openpyxl cannot copy sheets between workbooks or save a sheet with comments twice. Load the saved
+            # file once, and save each sheet of it once, either to its archive or back to the working file
+            workbook = openpyxl.load_workbook(self.filename)
+            sheets = workbook.worksheets
+            active = workbook.active
+            defined_names = workbook.defined_names
+            security = workbook.security
+            workbook.defined_names = DefinedNameList()
+            workbook.security = WorkbookProtection(lockStructure=True)
+            for sheet in [s for s in sheets if s.title in closed]:
+                path = paths[sheet.title]
+                for row in sheet.iter_rows():
+                    for cell in row:
+                        cell.protection = openpyxl.styles.Protection(locked=True)
+                sheet.protection.sheet = True
+                workbook._sheets = [sheet]
+                workbook.active = 0
+                workbook.save(path)
+                path.chmod(stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+                archived.append(str(path))
+                logger.info("Archived sheet [%s] to %s", sheet.title, path)
+
+            workbook._sheets = sheets
+            workbook.defined_names = defined_names
+            workbook.security = security
+            for name in closed:
+                workbook.remove(workbook[name])
+                self.remove_sheet(name)
+            workbook.active = workbook.worksheets.index(active) if active in workbook.worksheets else 0
+            logger.info("Saving workbook without archived sheets to file: %s", self.filename)
+            workbook.save(self.filename)
+            workbook.close()
+        return archived
+
+    def remove_sheet(self, name):
+        """Removes a year sheet from the workbook and from the sheet, column and slot indexes."""
+        sheet = self.workbook[name]
+        index = self.sheet_names.index(name)
+        del self.sheet_names[index]
+        del self.sheet_list[index]
+        self.columns = {key: value for key, value in self.columns.items() if value[0] is not sheet}
+        self.slots = {key: value for key, value in self.slots.items() if key[0] != name}
+        self.workbook.remove(sheet)
+
+    def get_references(self, names):
+        """Returns a dict of sheet name to the (sheet title, coordinate, formula) of formulas that refer to it.
+
+        Every sheet of the workbook is searched, and formulas of a sheet that refer to the sheet itself are left out.
+        """
+        references = {name: [] for name in names}
+        for sheet in self.workbook.worksheets:
+            for row in sheet.iter_rows():
+                for cell in row:
+                    if cell.data_type != 'f':
+                        continue
+                    for name in names:
+                        if name != sheet.title and name in str(cell.value):
+                            references[name].append((sheet.title, cell.coordinate, cell.value))
+        return references
+
     def close_workbook(self, overwrite=True, filename=None):
-        """Save and close the workbook"""
+        """Apply staged writes, save and close the workbook"""
         new_filename = self.filename
         if filename:
             new_filename = filename
@@ -283,29 +515,17 @@ class Excel:
         if not overwrite and filename is None:
             logger.warning("No filename provided. Discarding changes")
         else:
+            with metrics.timer('excel_apply_seconds'):
+                self.apply_plan()
             logger.info("Saving workbook to file: %s", new_filename)
-            self.workbook.save(new_filename)
+            with metrics.timer('excel_save_seconds'):
+                self.workbook.save(new_filename)
         self.workbook.close()
 
-    @staticmethod
-    def find_in_column(value, sheet, col, start_row, end_row):
-        """Search a column for a value and return the cell if found."""
-        if type(col) is int:
-            col = openpyxl.utils.get_column_letter(col)
-        cell_range = sheet[col + str(start_row):col + str(end_row)]
-        cell = [c[0] for c in cell_range if str(value) in str(c[0].value)]
-        if not cell:
-            return None
-        return cell[0]
-    
     def set_updating_member(self, username, month, year):
         """Write the member name doing the update to the correct cell"""
-        sheet = self.get_target_sheet(month, year % 2000)
-        header = self.get_column_headers(sheet)
-        # find correct column for current month
-        try:
-            column = header.index([month, year % 2000]) + 1
-        except ValueError:
+        sheet, column = self.get_column(month, year % 2000)
+        if not sheet:
             logger.warning("Error finding correct column: Month %s, Year %s",
                            month, year % 2000)
             return False
@@ -313,3 +533,242 @@ class Excel:
                     username, sheet.title, openpyxl.utils.get_column_letter(column), member_row)
         sheet.cell(row=member_row, column=column).value = username
         return True
+
+
+class ExcelExport:
+    """Writes a tracking workbook in the v7 layout from the database.
+
+    Uses openpyxl write only mode, so each sheet is streamed to the file as
+    it is built and memory use does not grow with the years of history.
+    Transactions are placed and merged into cells the same way as
+    Excel.add_transaction, in the order they were added to the database, so
+    the workbook matches one kept up to date run by run. Data cells are left
+    unlocked so that Excel can add to the workbook afterwards. The member
+    doing each update is not stored in the database and is left blank.
+
+    Sheets cover the month ranges of the sheets of an existing workbook.
+    Months outside those ranges are written to 12 month sheets that continue
+    from the nearest existing sheet, or that start in first_month when there
+    are no existing sheets.
+
+    Attributes:
+        filename: The name of the excel file to write.
+        workbook: The write only openpyxl Workbook.
+        periods: Sorted list of [first month, last month, sheet name] of each
+            sheet, where months are counted as year * 12 + month - 1.
+        first_month: The month new sheets start in when there are no sheets to continue from.
+    """
+
+    def __init__(self, filename, sheets=(), first_month=3):
+        """Starts a workbook with the sheet ranges of an existing workbook.
+
+        Args:
+            filename: The name of the excel file to write.
+            sheets: Optional. (sheet name, [start month, start year, end month, end year]) of the sheets of an
+                existing workbook, such as zip(ExcelReader.sheet_names, ExcelReader.sheet_list).
+            first_month: Optional. The month new sheets start in when there are no sheets to continue from.
+        """
+        self.filename = filename
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.unlocked = openpyxl.styles.Protection(locked=False)
+        self.first_month = first_month
+        self.periods = []
+        for name, sheet_range in sheets:
+            if len(sheet_range) != 4 or None in sheet_range:
+                logger.warning("Sheet %s does not name a month range and is not exported", name)
+                continue
+            start_month, start_year, end_month, end_year = sheet_range
+            self.periods.append([month_index(start_year, start_month), month_index(end_year, end_month), name])
+        self.periods.sort()
+
+    def get_period(self, index):
+        """Returns the [first month, last month, sheet name] of the sheet a month index is written to."""
+        for period in self.periods:
+            if period[0] <= index <= period[1]:
+                return period
+        before = [p for p in self.periods if p[1] < index]
+        after = [p for p in self.periods if p[0] > index]
+        if before:
+            start = before[-1][1] + 1 + (index - before[-1][1] - 1) // 12 * 12
+        elif after:
+            start = after[0][0] - 12 - (after[0][0] - 1 - index) // 12 * 12
+        else:
+            start = index - (index - self.first_month + 1) % 12
+        end = min([start + 11] + [p[0] - 1 for p in after])
+        start = max([start] + [p[1] + 1 for p in before])
+        period = [start, end, '{} - {}'.format(month_name(start), month_name(end))]
+        self.periods.append(period)
+        self.periods.sort()
+        return period
+
+    def export(self, db, until=None):
+        """Writes the workbook.
+
+        Args:
+            db: A topline.db.DB instance.
+            until: Optional. (year, month). Sheets are written up to the sheet
+                for this month, even if they have no transactions.
+
+        Returns:
+            The number of transactions written.
+        """
+        usernames = [u[1] for u in db.get_usernames()]
+        logger.info("Exporting %s members to workbook %s", len(usernames), self.filename)
+        self.write_summary(usernames, db.get_account_balances())
+        user_rows = {username: user_row + i for i, username in enumerate(usernames)}
+        if until is not None:
+            self.get_period(month_index(*until))
+        count = 0
+        for period, transactions in groupby(db.get_sheet_transactions(),
+                                            lambda t: self.get_period(month_index(t[1], t[2]))):
+            # sheets without transactions before this sheet are written empty
+            self.write_empty_sheets(period[0] - 1, user_rows)
+            # rows of a sheet are placed in the order they were added, the same as when updating the workbook
+            count += self.write_sheet(period, sorted(transactions), user_rows)
+        if self.periods:
+            self.write_empty_sheets(self.periods[-1][1], user_rows)
+        self.workbook.save(self.filename)
+        logger.info("Exported %s transactions to workbook %s", count, self.filename)
+        return count
+
+    def write_empty_sheets(self, last, user_rows):
+        # write the sheets that have not been written, from the first sheet up to the sheet ending in month index last
+        index = self.periods[0][0]
+        while index <= last:
+            period = self.get_period(index)
+            if period[2] not in self.workbook.sheetnames:
+                self.write_sheet(period, (), user_rows)
+            index = period[1] + 1
+
+    def cell(self, sheet, value=None, comment=None, locked=True):
+        cell = openpyxl.cell.WriteOnlyCell(sheet, value=value)
+        if comment:
+            cell.comment = openpyxl.comments.Comment(comment, 'Topline')
+        if not locked:
+            cell.protection = self.unlocked
+        return cell
+
+    def write_summary(self, usernames, balances):
+        # members from row 5 in column B and account numbers and balances from account_row in columns A and C
+        sheet = self.workbook.create_sheet('Summary')
+        accounts = {account_row + i: (acc_num, balance if active else 0)
+                    for i, (acc_num, balance, active) in enumerate(balances[:last_account_row - account_row + 1])}
+        if len(balances) > len(accounts):
+            logger.warning("No free row to add %s account balances", len(balances) - len(accounts))
+        for row in range(1, max(5 + len(usernames), last_account_row + 1)):
+            acc_num, balance = accounts.get(row, (None, 0 if account_row <= row <= last_account_row else None))
+            username = usernames[row - 5] if 0 <= row - 5 < len(usernames) else None
+            sheet.append([acc_num, username, balance])
+
+    def write_sheet(self, period, transactions, user_rows):
+        """Writes the sheet for a period from get_period and returns the transactions added."""
+        first, last, name = period
+        cells = {}
+        roi_labels = {}
+        free = {}
+        count = 0
+        for _, year, month, account, username, transaction_type, description, reference, amount in transactions:
+            column = month_index(year, month) - first + 2
+            comment = None
+            if transaction_type == 'contribution':
+                row = user_rows.get(username)
+            elif transaction_type == 'roi':
+                if account not in roi_labels and len(roi_labels) <= last_roi_row - roi_row:
+                    roi_labels[account] = roi_row + len(roi_labels)
+                row = roi_labels.get(account)
+            elif transaction_type == 'expense' and 'MONTHLY ACCOUNT FEE' in description.upper():
+                row = expense_row
+            elif transaction_type in ('income', 'expense'):
+                # income and other expenses each take the next empty row of their block in the month's column
+                row_first, row_last = (income_row, last_income_row) if transaction_type == 'income' else \
+                    (expense_row + 1, last_expense_row)
+                rows = free.setdefault((transaction_type, column), list(range(row_first, row_last + 1)))
+                row = rows.pop(0) if rows else None
+                comment = description + ' - ' + reference
+            else:
+                continue
+            if row is None:
+                logger.warning("[%s] No row for %s transaction of %s in column %s", name, transaction_type, amount,
+                               openpyxl.utils.get_column_letter(column))
+                continue
+            cells[(row, column)] = merge_cell(*cells.get((row, column), (None, None)), abs(amount), comment)
+            count += 1
+
+        sheet = self.workbook.create_sheet(name)
+        labels = {row: username for username, row in user_rows.items()}
+        labels.update({row: account for account, row in roi_labels.items()})
+        for row in range(1, last_expense_row + 1):
+            if row < member_row:
+                sheet.append([])
+            elif row == header_row:
+                sheet.append([None] + [self.cell(sheet, datetime(i // 12, i % 12 + 1, 1))
+                                       for i in range(first, last + 1)])
+            else:
+                sheet.append([self.cell(sheet, labels.get(row), locked=False)] +
+                             [self.cell(sheet, *cells.get((row, column), (None, None)), locked=False)
+                              for column in range(2, last - first + 3)])
+        logger.info("[%s] Exported %s transactions", sheet.title, count)
+        return count
+
+
+class ExcelReader:
+    """Read only view of an Excel workbook
+
+    Opens the workbook in openpyxl read only mode, which streams cell values
+    from the file instead of building the full workbook object model. Use
+    for validation and reporting where nothing is written back. Formula cells
+    return the value last calculated by Excel.
+
+    Attributes:
+        filename: The name of the excel file
+        sheet_names: The names of the month sheets, excluding the summary sheet.
+        sheet_list: The [start month, start year, end month, end year] range
+            of each sheet in sheet_names.
+        user_ids: The list of [index, username] from the summary sheet.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.sheet_names = []
+        self.sheet_list = []
+        self.user_ids = None
+        self.summary_sheet = None
+        self.workbook = None
+        try:
+            self.workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        except FileNotFoundError:
+            logger.error("File not found: %s", Path(filename).absolute())
+            return
+        for sheet in self.workbook.sheetnames:
+            if 'summary' in sheet.lower():
+                self.summary_sheet = self.workbook[sheet]
+            else:
+                self.sheet_names.append(sheet)
+                self.sheet_list.append(get_sheet_range(sheet))
+        # archive workbooks written by Excel.archive_years have no summary sheet
+        self.user_ids = self.get_user_ids() if self.summary_sheet else []
+
+    def get_user_ids(self):
+        """Returns a list of usernames from the summary sheet."""
+        user_ids = []
+        for row in self.summary_sheet.iter_rows(min_row=5, min_col=2, max_col=2):
+            if row[0].value is None:
+                break
+            user_ids.append([len(user_ids), row[0].value])
+        return user_ids
+
+    def get_column_headers(self, sheet_name):
+        """Returns a list of month and year references from column headers."""
+        rows = self.workbook[sheet_name].iter_rows(min_row=header_row, max_row=header_row)
+        return format_headers(next(rows, ()))
+
+    def get_values(self, sheet_name, min_row=None, max_row=None, min_col=None, max_col=None):
+        """Returns a list of rows of cell values from a range of a sheet."""
+        rows = self.workbook[sheet_name].iter_rows(min_row=min_row, max_row=max_row, min_col=min_col,
+                                                   max_col=max_col)
+        return [[c.value for c in row] for row in rows]
+
+    def close(self):
+        """Close the workbook file"""
+        if self.workbook:
+            self.workbook.close()
@@ -1,5 +1,8 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 import logging
+import threading
 from oauth2client import file, client, tools
 from googleapiclient.discovery import build
 from httplib2 import Http
@@ -9,6 +12,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
+from topline.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +21,9 @@ class Gmail:
     # If modifying these scopes, delete any existing credentials files
     SCOPE = 'https://www.googleapis.com/auth/gmail.send'
 
+    # encoded attachments by file path. See get_attachment
+    attachment_cache = {}
+
     def __init__(self, cred_path='~/.credentials'):
         self.credential_path = Path(cred_path).expanduser()
         if not self.credential_path.exists():
@@ -26,6 +33,8 @@ class Gmail:
                 self.credential_path.mkdir()
         self.secret_path = Path('credentials.json')
         self.service = None
+        self.credentials = None
+        self.local = threading.local()
 
     def authenticate(self):
         # Check for existing credentials
@@ -39,37 +48,29 @@ class Gmail:
                 logger.warning('Credentials json file not found: %s', self.secret_path)
                 return False
             flow = client.flow_from_clientsecrets(str(self.secret_path), self.SCOPE)
-            credentials = tools.run_flow(flow, store)
+            # run_flow parses sys.argv when no flags are given, which fails on topline.py's own options
+            credentials = tools.run_flow(flow, store, flags=tools.argparser.parse_args([]))
             logger.info('Storing credentials to %s', send_cred_path)
         logger.info('Credentials verified!')
+        self.credentials = credentials
         self.service = build('gmail', 'v1', http=credentials.authorize(Http()), cache_discovery=False)
         return True
 
+    def get_http(self):
+        # httplib2.Http is not thread safe. Use one authorised instance per thread
+        if not hasattr(self.local, 'http'):
+            self.local.http = self.credentials.authorize(Http())
+        return self.local.http
+
     @staticmethod
+    @metrics.timed('gmail_create_message_seconds')
     def create_message(to, subject, message_text, attachment_file=None):
         if attachment_file:
-            # Make sure attachment file exists
-            if not Path(attachment_file).exists():
-                logger.warning('Attachment file not found: %s', attachment_file)
+            attachment = Gmail.get_attachment(attachment_file)
+            if attachment is None:
                 return None
             message = MIMEMultipart()
             message.attach(MIMEText(message_text))
-            content_type, encoding = mimetypes.guess_type(attachment_file)
-
-            if content_type is None or encoding is not None:
-                content_type = 'application/octet-stream'
-            main_type, sub_type = content_type.split('/', 1)
-            if main_type == 'text':
-                with open(attachment_file, 'rb') as fp:
-                    msg = MIMEText(fp.read(), _subtype=sub_type)
-            else:
-                msg = MIMEBase(main_type, sub_type)
-                with open(attachment_file, 'rb') as fp:
-                    msg.set_payload(fp.read())
-            encoders.encode_base64(msg)
-            filename = Path(attachment_file).name
-            msg.add_header('Content-Disposition', 'attachment', filename=filename)
-            message.attach(msg)
         else:
             message = MIMEText(message_text)
 
@@ -78,7 +79,54 @@ class Gmail:
         # message['from'] = sender
         message['to'] = to
         message['subject'] = subject
-        return {'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+        raw = message.as_bytes()
+        if attachment_file:
+            # add the encoded attachment as the last part of the message
+            end = b'\n--' + message.get_boundary().encode() + b'--'
+            head, end, tail = raw.rpartition(end)
+            raw = b''.join((head, end[:-2], b'\n', attachment, end, tail))
+        return {'raw': base64.urlsafe_b64encode(raw).decode()}
+
+    @staticmethod
+    def get_attachment(attachment_file):
+        """Returns the encoded MIME part for an attachment file.
+
+        The part is built once for each version of the file, identified by
+        its path, modification time and size, and kept in
+        Gmail.attachment_cache. Only the latest version of each file is kept.
+
+        Returns:
+            The MIME part as bytes. None if the file does not exist.
+        """
+        # Make sure attachment file exists
+        path = Path(attachment_file)
+        if not path.exists():
+            logger.warning('Attachment file not found: %s', attachment_file)
+            return None
+        stat = path.stat()
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = Gmail.attachment_cache.get(path.resolve())
+        if cached and cached[0] == version:
+            return cached[1]
+
+        logger.debug('Encoding attachment: %s', attachment_file)
+        content_type, encoding = mimetypes.guess_type(attachment_file)
+
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+        main_type, sub_type = content_type.split('/', 1)
+        if main_type == 'text':
+            with open(attachment_file, 'rb') as fp:
+                msg = MIMEText(fp.read(), _subtype=sub_type)
+        else:
+            msg = MIMEBase(main_type, sub_type)
+            with open(attachment_file, 'rb') as fp:
+                msg.set_payload(fp.read())
+        encoders.encode_base64(msg)
+        msg.add_header('Content-Disposition', 'attachment', filename=path.name)
+        attachment = msg.as_bytes()
+        Gmail.attachment_cache[path.resolve()] = (version, attachment)
+        return attachment
 
     def send_message(self, user_id, message):
         if message is not None:
@@ -90,3 +138,93 @@ class Gmail:
                 logger.error('An error occurred trying to send email: %s' % error)
         else:
             logger.error("Message is empty. Unable to send email!")
+
+    def send_messages(self, user_id, messages, workers=4, retries=5, on_start=None, on_done=None):
+        """Sends several messages at the same time.
+
+        Messages are sent from a pool of worker threads, each with its own
+        HTTP connection. Rate limit and server errors are retried with
+        exponential backoff. At most workers messages are in flight, and the
+        callbacks are called in the calling thread as each message starts
+        and finishes. Messages are taken from the iterable only when a worker
+        is free, so a generator that builds each message keeps at most
+        workers messages in memory.
+
+        Args:
+            user_id: The sender, 'me' for the authenticated user.
+            messages: An iterable of (recipient, message) tuples, where
+                message is returned by create_message.
+            workers: Optional. The number of messages sent at once.
+            retries: Optional. The number of times a failed request is retried.
+            on_start: Optional. Called with the index of each message just
+                before it is sent.
+            on_done: Optional. Called with the index, recipient and result of
+                each message as soon as it is sent or fails.
+
+        Returns:
+            A list of (recipient, result) tuples in the order of messages, where
+            result is the sent message or None if sending failed.
+        """
+        def send(item):
+            to, message = item
+            if message is None:
+                logger.error("Message to %s is empty. Unable to send email!", to)
+                return to, None
+            try:
+                with metrics.timer('gmail_send_seconds'):
+                    result = self.service.users().messages().send(userId=user_id, body=message).execute(
+                        http=self.get_http(), num_retries=retries)
+                logger.debug('Message to %s Id: %s', to, result['id'])
+                metrics.count('gmail_emails_total', status='sent')
+                return to, result
+            except Exception as error:
+                logger.error('An error occurred trying to send email to %s: %s', to, error)
+                metrics.count('gmail_emails_total', status='failed')
+                return to, None
+
+        results = {}
+        pending = iter(enumerate(messages))
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                for i, item in islice(pending, workers - len(running)):
+                    if on_start:
+                        on_start(i)
+                    running[executor.submit(send, item)] = i
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = running.pop(future)
+                    results[i] = future.result()
+                    if on_done:
+                        on_done(i, *results[i])
+        results = [results[i] for i in range(len(results))]
+        logger.info("Sent %s/%s emails", sum(1 for _, result in results if result), len(results))
+        return results
+
+    def send_outbox(self, db, user_id='me', workers=4):
+        """Sends every queued or failed email in the database outbox and records the results.
+
+        Each email is marked as sending just before it is sent, and as sent
+        or failed as soon as it completes, so an interrupted drain leaves at
+        most workers emails marked as sending. Those are not sent again
+        until they are requeued with DB.requeue_interrupted_emails.
+
+        Args:
+            db: A topline.db.DB instance.
+            user_id: The sender, 'me' for the authenticated user.
+            workers: Optional. The number of messages sent at once.
+
+        Returns:
+            The number of emails sent.
+        """
+        emails = db.get_pending_emails()
+        # each message is built when a worker is free to send it, so at most workers encoded messages are held
+        messages = ((email[1], self.create_message(*email[1:])) for email in emails)
+
+        def done(i, to, result):
+            db.update_email(emails[i][0], result is not None, result and result['id'])
+        results = self.send_messages(user_id, messages, workers=workers,
+                                     on_start=lambda i: db.mark_email_sending(emails[i][0]), on_done=done)
+        return sum(1 for _, result in results if result)
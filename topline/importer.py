@@ -0,0 +1,161 @@
+import csv
+import re
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# date formats found in FNB statement exports and the transaction history file
+DATE_FORMATS = ('%d %b %Y', '%d-%b-%Y', '%Y/%m/%d', '%Y-%m-%d', '%d/%m/%Y', '%Y%m%d')
+
+# columns of the headerless transaction history file read by DB.initialise_transactions
+HISTORY_COLUMNS = {'date': 0, 'description': 1, 'reference': 2, 'amount': 3, 'balance': 4, 'account': 5}
+
+
+def format_date(s):
+    # return a date string in the format used by FNB.get_transactions, None if s is not a date
+    s = s.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(s, date_format).strftime('%d %b %Y')
+        except ValueError:
+            pass
+    return None
+
+
+def read_statement(filename, account=None):
+    """Reads transactions from an FNB CSV or OFX statement export.
+
+    Rows are read one at a time so memory use does not grow with the size of
+    the file. The file type and CSV column layout are detected from the file.
+
+    Args:
+        filename: The statement file.
+        account: Optional. The account number of the transactions. If not
+            given, it is read from the file.
+
+    Yields:
+        (transaction, account) pairs, where transaction is a tuple in the
+        format returned by FNB.get_transactions, in the order they appear in
+        the file.
+    """
+    logger.info("Reading transactions from statement %s", filename)
+    with open(filename, 'r', newline='') as f:
+        start = f.read(1024)
+        f.seek(0)
+        if 'OFXHEADER' in start or '<OFX>' in start.upper():
+            yield from read_ofx(f, account)
+        else:
+            yield from read_csv(f, account)
+
+
+def read_csv(f, account=None):
+    # yield transactions from a csv file object, detecting the column layout from the header row
+    columns = None
+    for row in csv.reader(f):
+        cells = [c.strip() for c in row]
+        if not any(cells):
+            continue
+        if columns is None:
+            if len(cells) == len(HISTORY_COLUMNS) and format_date(cells[0]) and cells[-1].isdigit():
+                columns = HISTORY_COLUMNS
+            else:
+                account = account or find_account(cells)
+                columns = get_columns(cells)
+                continue
+        date = format_date(cells[columns['date']]) if columns['date'] < len(cells) else None
+        if not date:
+            # skip opening and closing balance lines
+            continue
+        acc_num = int(cells[columns['account']]) if columns.get('account', len(cells)) < len(cells) else account
+        if acc_num is None:
+            logger.error("Account number not found in statement. Unable to import transactions")
+            return
+        yield (date,) + tuple(cells[columns[c]] if columns.get(c, len(cells)) < len(cells) else ''
+                              for c in ('description', 'reference', 'fee', 'amount', 'balance')), acc_num
+    if columns is None:
+        logger.warning("No transactions found in statement")
+
+
+def get_columns(cells):
+    # return a dict of column name to index from a header row, None if the row is not a header
+    names = [c.lower() for c in cells]
+    if not any('date' in n for n in names) or not any('amount' in n for n in names):
+        return None
+    columns = {}
+    descriptions = []
+    for i, name in enumerate(names):
+        if 'date' in name:
+            columns.setdefault('date', i)
+        elif 'description' in name or name in ('narrative', 'details'):
+            descriptions.append(i)
+        elif 'reference' in name:
+            columns.setdefault('reference', i)
+        elif 'amount' in name:
+            columns.setdefault('amount', i)
+        elif 'balance' in name:
+            columns.setdefault('balance', i)
+        elif 'fee' in name or 'charge' in name:
+            columns.setdefault('fee', i)
+        elif 'account' in name:
+            columns.setdefault('account', i)
+    if descriptions:
+        columns['description'] = descriptions[0]
+        if len(descriptions) > 1:
+            columns.setdefault('reference', descriptions[1])
+    logger.debug("Statement columns: %s", columns)
+    return columns
+
+
+def find_account(cells):
+    # return the account number from a statement heading row, None if not found
+    if not any('account' in c.lower() for c in cells):
+        return None
+    for c in cells:
+        number = re.search(r'\d{6,}', c)
+        if number:
+            return int(number.group())
+    return None
+
+
+def read_ofx(f, account=None):
+    # yield transactions from an ofx file object
+    transaction = None
+    for line in f:
+        for tag, value in re.findall(r'<(/?[A-Z0-9.]+)>([^<\r\n]*)', line):
+            value = value.strip()
+            if tag == 'ACCTID' and account is None:
+                account = int(re.sub(r'\D', '', value))
+            elif tag == 'STMTTRN':
+                transaction = {}
+            elif tag == '/STMTTRN' and transaction is not None:
+                if account is None:
+                    logger.error("Account number not found in statement. Unable to import transactions")
+                    return
+                date = format_date(transaction.get('DTPOSTED', '')[:8])
+                if date:
+                    yield (date, transaction.get('NAME', ''), transaction.get('MEMO', ''), '',
+                           transaction.get('TRNAMT', ''), ''), account
+                else:
+                    logger.warning("Skipping transaction without a valid date: %s", transaction)
+                transaction = None
+            elif transaction is not None:
+                transaction[tag] = value
+
+
+if __name__ == '__main__':
+    import argparse
+    from topline.db import DB
+
+    parser = argparse.ArgumentParser(description='Import FNB CSV or OFX statements into the database')
+    parser.add_argument('db', help='database file')
+    parser.add_argument('statements', nargs='+', help='statement files to import')
+    parser.add_argument('--account', type=int, help='account number, if not in the statement files')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(module)-12s %(levelname)-8s %(message)s')
+
+    db = DB(args.db)
+    if db.connection:
+        for statement in args.statements:
+            db.import_statement(statement, args.account)
+        db.close_db()
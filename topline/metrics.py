@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+
+class NullTimer:
+    # shared context manager returned by Metrics.timer while metrics are disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """Counters, timers and histograms for a run of the tracker.
+
+    Metrics are disabled by default. While disabled, count and observe return
+    immediately and timer returns a shared no-op context manager, so the
+    instrumentation left in the code costs one attribute lookup per call.
+
+    Metrics are identified by name and optional labels, for example
+    metrics.count('gmail_emails_total', status='sent'). Timers record seconds
+    into the histogram of the same name.
+
+    Attributes:
+        enabled: True if metrics are being recorded.
+        counters: Dict of (name, labels) to the counter value.
+        histograms: Dict of (name, labels) to the list of observed values.
+    """
+
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.null_timer = NullTimer()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.histograms.setdefault(key, []).append(value)
+
+    def timer(self, name, **labels):
+        """Returns a context manager that records the seconds spent inside it in the histogram name."""
+        if not self.enabled:
+            return self.null_timer
+        return Timer(self, name, labels)
+
+    def timed(self, name, **labels):
+        """Returns a decorator that records the seconds spent in each call of the decorated function."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Timer(self, name, labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """Returns a dict of metric name to a list of its values by label.
+
+        Counters are given as {'labels': {...}, 'value': n}. Histograms are
+        given as {'labels': {...}, 'count': n, 'sum': s, 'min': x, 'max': y,
+        'quantiles': {q: v}}.
+        """
+        summary = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                summary.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), values in sorted(self.histograms.items()):
+                ordered = sorted(values)
+                summary.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': len(ordered),
+                    'sum': sum(ordered),
+                    'min': ordered[0],
+                    'max': ordered[-1],
+                    'quantiles': {str(q): ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+                                  for q in self.quantiles}})
+        return summary
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format, with histograms as summaries."""
+        lines = []
+        for name, series in self.summary().items():
+            metric = 'topline_' + name
+            lines.append('# TYPE {} {}'.format(metric, 'summary' if 'count' in series[0] else 'counter'))
+            for s in series:
+                labels = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in s['labels'].items())
+                if 'count' not in s:
+                    lines.append('{}{} {}'.format(metric, '{' + labels + '}' if labels else '', s['value']))
+                    continue
+                for q, value in s['quantiles'].items():
+                    quantile = ','.join(filter(None, [labels, 'quantile="{}"'.format(q)]))
+                    lines.append('{}{{{}}} {}'.format(metric, quantile, value))
+                lines.append('{}_sum{} {}'.format(metric, '{' + labels + '}' if labels else '', s['sum']))
+                lines.append('{}_count{} {}'.format(metric, '{' + labels + '}' if labels else '', s['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file=None, prometheus_file=None):
+        """Writes the metrics summary to a JSON file and/or a Prometheus textfile collector file.
+
+        Files are written to a temporary file and renamed, so a collector never reads a partial file.
+        """
+        if not self.enabled:
+            return
+        for filename, text in ((json_file, lambda: json.dumps(self.summary(), indent=2)),
+                               (prometheus_file, self.prometheus)):
+            if filename:
+                path = Path(filename)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix(path.suffix + '.tmp')
+                tmp.write_text(text())
+                tmp.replace(path)
+                logger.info("Metrics written to %s", path)
+
+
+# metrics shared by all modules, enabled by topline.py from config.ini
+metrics = Metrics()
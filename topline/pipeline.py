@@ -0,0 +1,245 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from time import perf_counter
+from topline.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    def __init__(self, name, func, requires=(), checkpoint=True):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.checkpoint = checkpoint
+
+
+class Pipeline:
+    """Runs named stages, checkpointing the output of each stage to disk.
+
+    Each stage is a function that takes no arguments and returns its result.
+    Stages list the stages they require, and a stage is started in a thread as
+    soon as all of the stages it requires are done, so independent stages run
+    at the same time. Stages must be added after the stages they require, and
+    must require every stage whose result they read.
+
+    Results of checkpointed stages must be JSON serialisable. They are saved
+    to <checkpoint_dir>/<stage>.json with the pipeline's run id and are
+    available to later stages in Pipeline.results. When resuming from a
+    stage, or running a single stage, the results of the stages before it
+    are loaded from their checkpoints instead of being run again. Checkpoints
+    saved with a different run id are rejected. Stages that are not
+    checkpointed, such as opening the workbook or authenticating with Gmail,
+    are run again whenever a stage that requires them is run.
+
+    A stage that commits its work in steps can save its partial result with
+    save_progress after each step, and read it back with load_progress when
+    it is run again after failing. Partial results are removed when the
+    stage completes.
+
+    Attributes:
+        stages: List of topline.pipeline.Stage in the order they were added.
+        results: Dict of stage name to the stage's result.
+        timings: Dict of stage name to the (start, end) seconds of the stage from the start of the run.
+        checkpoint_dir: pathlib.Path of the directory checkpoints are saved in.
+        run_id: String identifying the run checkpoints belong to, such as the month of the run.
+    """
+
+    def __init__(self, checkpoint_dir='checkpoints', run_id=None):
+        self.stages = []
+        self.results = {}
+        self.timings = {}
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.run_id = run_id
+
+    def stage(self, name, requires=(), checkpoint=True):
+        """Returns a decorator that adds the decorated function as a stage of the pipeline.
+
+        Args:
+            name: The name of the stage.
+            requires: Optional. Names of the stages that must be done before this stage starts.
+            checkpoint: Optional. False if the stage's result is not saved and the stage is run again when needed.
+        """
+        def add_stage(func):
+            unknown = [r for r in requires if r not in self.names]
+            if unknown:
+                raise ValueError("Stage {} requires unknown stages {}".format(name, unknown))
+            self.stages.append(Stage(name, func, requires, checkpoint))
+            return func
+        return add_stage
+
+    @property
+    def names(self):
+        return [stage.name for stage in self.stages]
+
+    def get_stage(self, name):
+        return self.stages[self.names.index(name)]
+
+    def requirements(self, name):
+        """Returns the names of the stages a stage requires, directly or through other stages."""
+        required = set()
+        pending = list(self.get_stage(name).requires)
+        while pending:
+            r = pending.pop()
+            if r not in required:
+                required.add(r)
+                pending.extend(self.get_stage(r).requires)
+        return required
+
+    def checkpoint_path(self, name, partial=False):
+        return self.checkpoint_dir.joinpath('{}{}.json'.format(name, '.partial' if partial else ''))
+
+    def save_checkpoint(self, name, result, partial=False):
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        path = self.checkpoint_path(name, partial)
+        # write to a temporary file first so an interrupted run never leaves a partial checkpoint
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'run_id': self.run_id, 'result': result}, f, default=str)
+        tmp.replace(path)
+        logger.debug("Saved checkpoint for stage %s to %s", name, path)
+
+    def read_checkpoint(self, path):
+        # return the checkpoint in path, None if it is missing or belongs to another run
+        if not path.is_file():
+            return None
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if not isinstance(checkpoint, dict) or 'result' not in checkpoint or checkpoint.get('run_id') != self.run_id:
+            logger.error("Checkpoint %s belongs to run %s, not %s", path,
+                         checkpoint.get('run_id') if isinstance(checkpoint, dict) else None, self.run_id)
+            return None
+        return checkpoint
+
+    def load_checkpoint(self, name):
+        path = self.checkpoint_path(name)
+        if not path.is_file():
+            logger.error("No checkpoint found for stage %s at %s", name, path)
+            return False
+        checkpoint = self.read_checkpoint(path)
+        if checkpoint is None:
+            logger.error("Run stage %s again instead of loading its checkpoint", name)
+            return False
+        self.results[name] = checkpoint['result']
+        logger.info("Loaded checkpoint for stage %s", name)
+        return True
+
+    def save_progress(self, name, result):
+        """Saves the partial result of a running stage, so it can continue from it if it fails."""
+        self.save_checkpoint(name, result, partial=True)
+
+    def load_progress(self, name):
+        """Returns the partial result saved by an earlier attempt of a stage that failed, None if there is none."""
+        checkpoint = self.read_checkpoint(self.checkpoint_path(name, partial=True))
+        if checkpoint is None:
+            return None
+        logger.info("Loaded partial result of stage %s", name)
+        return checkpoint['result']
+
+    def select(self, start=None, only=None):
+        # return the stages to run. Earlier stages are loaded from checkpoints, unless they are not checkpointed
+        first = only or start or self.names[0]
+        index = self.names.index(first)
+        selected = {first} if only else set(self.names[index:])
+        for stage in reversed(self.stages):
+            if stage.name in selected:
+                selected.update(r for r in stage.requires if not self.get_stage(r).checkpoint)
+        return [stage for stage in self.stages if stage.name in selected]
+
+    def run_stage(self, stage, start_time):
+        logger.info("Running stage %s", stage.name)
+        started = perf_counter() - start_time
+        result = stage.func()
+        self.timings[stage.name] = (started, perf_counter() - start_time)
+        metrics.observe('pipeline_stage_seconds', self.timings[stage.name][1] - started, stage=stage.name)
+        if stage.checkpoint:
+            self.save_checkpoint(stage.name, result)
+            self.checkpoint_path(stage.name, partial=True).unlink(missing_ok=True)
+            # later stages see the result as it is stored, the same as when it is loaded from the checkpoint
+            result = json.loads(json.dumps(result, default=str))
+        self.results[stage.name] = result
+        logger.info("Stage %s done in %.2fs", stage.name, self.timings[stage.name][1] - started)
+        return result
+
+    def run(self, start=None, only=None, workers=None):
+        """Runs the pipeline.
+
+        Args:
+            start: Optional. The name of the stage to resume from. Earlier
+                stages are loaded from their checkpoints.
+            only: Optional. The name of the single stage to run. Earlier
+                stages are loaded from their checkpoints and later stages are
+                not run.
+            workers: Optional. The number of stages that may run at the same
+                time. Defaults to the number of stages.
+
+        Returns:
+            True if all stages that were run completed.
+            False if a checkpoint could not be loaded or a stage failed.
+        """
+        first = only or start
+        if first and first not in self.names:
+            logger.error("Unknown stage %s. Stages are: %s", first, ', '.join(self.names))
+            return False
+        pending = self.select(start, only)
+        pending_names = [stage.name for stage in pending]
+        # load every checkpointed stage the selected stages depend on, including through stages that are not run
+        required = set().union(*(self.requirements(s.name) for s in pending))
+        for stage in self.stages:
+            if stage.name in required and stage.name not in pending_names and stage.checkpoint:
+                if not self.load_checkpoint(stage.name):
+                    return False
+
+        self.timings = {}
+        done = set(self.results)
+        running = {}
+        failed = False
+        start_time = perf_counter()
+        with ThreadPoolExecutor(max_workers=workers or len(self.stages)) as executor:
+            while pending or running:
+                if not failed:
+                    for stage in [s for s in pending if all(r in done for r in s.requires)]:
+                        pending.remove(stage)
+                        running[executor.submit(self.run_stage, stage, start_time)] = stage
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    if future.exception():
+                        logger.error("Stage %s failed. Resume with --from %s", stage.name, stage.name,
+                                     exc_info=future.exception())
+                        failed = True
+                    else:
+                        done.add(stage.name)
+        if self.timings:
+            self.log_critical_path(perf_counter() - start_time)
+        return not failed
+
+    def critical_path(self):
+        """Returns the names of the stages on the critical path of the last run, first stage first.
+
+        The path ends at the stage that finished last, and each stage before it is the required stage that
+        finished last, so it is the chain of stages that determined the wall time of the run.
+        """
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while True:
+            requires = [r for r in self.get_stage(name).requires if r in self.timings]
+            if not requires:
+                break
+            name = max(requires, key=lambda r: self.timings[r][1])
+            path.append(name)
+        return path[::-1]
+
+    def log_critical_path(self, total):
+        path = self.critical_path()
+        logger.info("Pipeline done in %.2fs. Critical path: %s", total, ' -> '.join(
+            '{} ({:.2f}s)'.format(name, self.timings[name][1] - self.timings[name][0]) for name in path))
+        for name, (started, ended) in sorted(self.timings.items(), key=lambda t: t[1]):
+            logger.info("Stage %-16s %7.2fs - %7.2fs%s", name, started, ended,
+                        '' if name in path else ' (off critical path)')
@@ -1,18 +1,119 @@
 from selenium import webdriver
-from selenium.common.exceptions import WebDriverException, NoSuchElementException, TimeoutException
+from selenium.common.exceptions import WebDriverException, NoSuchElementException, TimeoutException, \
+    StaleElementReferenceException
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium.webdriver.chrome.options import Options as ChromeOptions
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import queue
 import time
 import logging
 import re
+from topline.transaction import get_new_transactions
+from topline.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 
+class attribute_is_not:
+    """Expected condition that an element attribute is not a value. Comparison is case insensitive."""
+
+    def __init__(self, locator, attribute, value):
+        self.locator = locator
+        self.attribute = attribute
+        self.value = value.lower()
+
+    def __call__(self, driver):
+        element = driver.find_element(*self.locator)
+        return (element.get_attribute(self.attribute) or '').lower() != self.value
+
+
+class any_of:
+    """Expected condition that any of the given conditions is true. Returns the first true result."""
+
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def __call__(self, driver):
+        for condition in self.conditions:
+            try:
+                result = condition(driver)
+                if result:
+                    return result
+            except (NoSuchElementException, StaleElementReferenceException):
+                pass
+        return False
+
+
+class WaitPolicy:
+    """Waits for expected conditions with a timeout and backing off poll interval.
+
+    Conditions are callables taking the driver, as in
+    selenium.webdriver.support.expected_conditions. The condition is polled
+    every poll_frequency seconds, with the interval multiplied by backoff after
+    every poll up to max_poll_frequency. The time taken by every wait is
+    recorded.
+
+    Attributes:
+        timeout: Seconds to wait before giving up.
+        poll_frequency: Seconds to sleep after the first poll.
+        backoff: Multiplier applied to the sleep after every poll.
+        max_poll_frequency: Longest sleep between polls.
+        timings: A list of (name, seconds, success) tuples, one per wait.
+    """
+
+    ignored_exceptions = (NoSuchElementException, StaleElementReferenceException)
+
+    def __init__(self, timeout=30, poll_frequency=0.05, backoff=1.5, max_poll_frequency=0.5):
+        self.timeout = timeout
+        self.poll_frequency = poll_frequency
+        self.backoff = backoff
+        self.max_poll_frequency = max_poll_frequency
+        self.timings = []
+
+    def until(self, driver, condition, name='wait', timeout=None):
+        """Waits until condition returns a true value and returns it.
+
+        Raises:
+            TimeoutException: If the condition is not true within the timeout.
+        """
+        start = time.perf_counter()
+        end_time = start + (self.timeout if timeout is None else timeout)
+        poll = self.poll_frequency
+        while True:
+            try:
+                value = condition(driver)
+                if value:
+                    self.record(name, start, True)
+                    return value
+            except self.ignored_exceptions:
+                pass
+            if time.perf_counter() + poll > end_time:
+                break
+            time.sleep(poll)
+            poll = min(poll * self.backoff, self.max_poll_frequency)
+        self.record(name, start, False)
+        raise TimeoutException("Timed out waiting for {}".format(name))
+
+    def record(self, name, start, success):
+        elapsed = time.perf_counter() - start
+        self.timings.append((name, elapsed, success))
+        metrics.observe('fnb_wait_seconds', elapsed, wait=name)
+        if not success:
+            metrics.count('fnb_wait_timeouts_total', wait=name)
+        logger.debug("Wait for %s %s after %.3fs", name, 'done' if success else 'timed out', elapsed)
+
+    def summary(self):
+        """Returns a dict of wait name to (count, total seconds, timeouts)."""
+        summary = {}
+        for name, elapsed, success in self.timings:
+            count, total, timeouts = summary.get(name, (0, 0.0, 0))
+            summary[name] = (count + 1, total + elapsed, timeouts + (not success))
+        return summary
+
+
 class Scraper:
     def __init__(self, driver, headless=False, driver_path=None):
         driver = driver.lower()
@@ -23,6 +124,17 @@ class Scraper:
             self.driver = self.init_chrome_driver(headless, driver_path)
         else:
             logger.error("Invalid or unsupported driver. Drivers supported: Chrome, Firefox")
+        if self.driver and metrics.enabled:
+            self.count_commands()
+
+    def count_commands(self):
+        # count every WebDriver command. Element methods are sent through the driver's execute method as well
+        execute = self.driver.execute
+
+        def counted_execute(driver_command, params=None):
+            metrics.count('fnb_webdriver_commands_total', command=driver_command)
+            return execute(driver_command, params)
+        self.driver.execute = counted_execute
 
     @staticmethod
     def init_firefox_driver(headless):
@@ -58,10 +170,90 @@ class Scraper:
 
 
 class FNB(Scraper):
-    def __init__(self, driver, headless=False, driver_path=None):
+    # page elements waited on
+    loader = (By.XPATH, '//*[@id="loaderOverlay"]')
+    login_overlay = (By.XPATH, '//*[@id="zaSkin"]/body/div[40]')
+    popup_footer = (By.XPATH, "//div[@id='footerButtonGroup']")
+    landing_page = (By.XPATH, "//*[@id='newsLanding']/div[3]/ul/li[1]/div")
+
+    # table columns. names, numbers and balances on the accounts page
+    account_xpaths = ('//*[contains(@id,"nickname")]', '//*[contains(@id,"accountNumber")]',
+                      '//*[contains(@id,"ledgerBalance")]')
+    # the account name column's ids are the nicknames clicked to open each account
+    account_id_columns = (0,)
+    # dates, descriptions, references, fees, amounts and balances on the transaction history page
+    transaction_xpaths = ('//*[@id="counter"]', '//*[@id="shortDescription"]', '//*[@id="reference"]',
+                          '//*[@id="serviceFee"]', '//*[contains(@id,"amount")]', '//*[@id="ledgerBalance"]')
+
+    # returns [text, id] of every element matching each xpath in arguments[0]
+    extract_script = """
+        return arguments[0].map(function (xpath) {
+            var result = document.evaluate(xpath, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+            var elements = [];
+            for (var i = 0; i < result.snapshotLength; i++) {
+                var element = result.snapshotItem(i);
+                elements.push([(element.innerText || '').trim(), element.id]);
+            }
+            return elements;
+        });
+    """
+
+    def __init__(self, driver, headless=False, driver_path=None, wait_policy=None, script_extraction=True):
         super().__init__(driver, headless=headless, driver_path=driver_path)
         self.accounts = {}
+        self.waits = wait_policy or WaitPolicy()
+        self.script_extraction = script_extraction
+
+    @classmethod
+    def open_sessions(cls, count, url, username, password, **options):
+        """Starts count browser sessions and logs them all in at the same time.
+
+        Args:
+            count: The number of sessions.
+            url: The FNB login page.
+            username: The FNB username.
+            password: The FNB password.
+            options: Keyword arguments for FNB, such as driver and wait_policy.
+
+        Returns:
+            A list of the logged in FNB instances. Sessions whose browser
+            fails to start, whose login times out or that raise any other
+            error are closed and left out.
+
+        Raises:
+            SystemExit: If the login is rejected. Every other session is closed first.
+        """
+        def open_session(i):
+            session = cls(**options)
+            if not session.driver:
+                return None
+            try:
+                session.driver.get(url)
+                if session.login(username, password):
+                    return session
+            except SystemExit:
+                # login quits the driver before rejecting the credentials
+                raise
+            except Exception:
+                logger.exception("Session %d failed to log in", i + 1)
+            try:
+                session.driver.quit()
+            except Exception:
+                logger.debug("Unable to quit the driver of session %d", i + 1)
+            return None
+
+        with ThreadPoolExecutor(max_workers=max(count, 1)) as executor:
+            futures = [executor.submit(open_session, i) for i in range(count)]
+        sessions = [f.result() for f in futures if not f.exception() and f.result()]
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            for session in sessions:
+                session.driver.quit()
+            raise errors[0]
+        logger.info("Logged in %d of %d sessions", len(sessions), count)
+        return sessions
 
+    @metrics.timed('fnb_login_seconds')
     def login(self, username, password):
         user_field = self.driver.find_element_by_xpath("//input[@id='user']")
         pass_field = self.driver.find_element_by_xpath("//input[@id='pass']")
@@ -70,7 +262,13 @@ class FNB(Scraper):
         pass_field.send_keys(password)
 
         self.driver.find_element_by_xpath("//input[@id='OBSubmit']").click()
-        time.sleep(1)
+        # wait for the login to fail, a popup or the landing page
+        try:
+            self.waits.until(self.driver, any_of(EC.visibility_of_element_located(self.login_overlay),
+                                                 EC.presence_of_element_located(self.popup_footer),
+                                                 EC.presence_of_element_located(self.landing_page)), 'login')
+        except TimeoutException:
+            logger.debug("Timeout waiting for login")
 
         try:
             overlay = self.driver.find_element_by_xpath('//*[@id="zaSkin"]/body/div[40]')
@@ -91,8 +289,7 @@ class FNB(Scraper):
             logger.debug("No popup")
 
         try:
-            WebDriverWait(self.driver, 30).until(
-                EC.presence_of_element_located((By.XPATH, "//*[@id='newsLanding']/div[3]/ul/li[1]/div")))
+            self.waits.until(self.driver, EC.presence_of_element_located(self.landing_page), 'landing page')
         except TimeoutException:
             logger.debug("Timeout")
             return False
@@ -117,70 +314,122 @@ class FNB(Scraper):
             return False
         return True
 
-    def get_accounts(self, get_transactions=True):
+    def get_accounts(self, get_transactions=True, sessions=None, marks=None):
         # Go to accounts page
         if not self.load_account_page():
             return False
 
-        accounts_table = self.driver.find_element_by_id("accountsTable_tableContent")
-        account_names = accounts_table.find_elements_by_xpath('//*[contains(@id,"nickname")]')
-        account_numbers = accounts_table.find_elements_by_xpath('//*[contains(@id,"accountNumber")]')
-        account_balances = accounts_table.find_elements_by_xpath('//*[contains(@id,"ledgerBalance")]')
-        
-        for i in range(len(account_names)):
-            name = account_names[i].text
-            nickname = account_names[i].get_attribute('id')
-            acc_num = int(account_numbers[i].text)
-            balance = re.sub("[^0-9.]", '', account_balances[i].text)
-            self.accounts[acc_num] = {'name': name, 'nickname': nickname, 'balance': float(balance)}
+        self.driver.find_element_by_id("accountsTable_tableContent")
+        account_names, account_numbers, account_balances = self.extract_columns(self.account_xpaths,
+                                                                                self.account_id_columns)
+
+        for (name, nickname), (acc_num, _), (balance, _) in zip(account_names, account_numbers, account_balances):
+            balance = re.sub("[^0-9.]", '', balance)
+            self.accounts[int(acc_num)] = {'name': name, 'nickname': nickname, 'balance': float(balance)}
         logger.info("Found %d accounts", len(self.accounts))
         
         if get_transactions:
             for account in self.accounts:
-                logger.info("Getting transactions for account: %s", self.accounts[account]['name'])
-                # Open account
-                # Can't click account if link is off page so scroll to bottom and click again if it fails
-                try:
-                    self.driver.find_element_by_id(self.accounts[account]['nickname']).click()
-                except WebDriverException:
-                    self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                    # Another try catch?
-                    self.driver.find_element_by_id(self.accounts[account]['nickname']).click()
-
-                self.wait_for_loader()
                 self.accounts[account]['transactions'] = []
-                transactions = self.get_transactions()
-                if transactions:
-                    self.accounts[account]['transactions'] = transactions
-                    logger.info("Found %d transactions", len(self.accounts[account]['transactions']))
-                elif len(transactions) == 0:
-                    logger.info("No transactions found for account")
-                else:
-                    logger.warning("Unable to get transactions!")
-                # Go back to accounts page before going to next account
-                if not self.load_account_page():
+            marks = marks or {}
+            if sessions:
+                return self.get_transactions_concurrently(sessions, marks)
+            for account in self.accounts:
+                if not self.get_account_transactions(self.accounts[account], marks.get(account)):
                     return False
         return True
 
-    def get_transactions(self):
+    def get_account_transactions(self, account, mark=None):
+        """Opens an account from the accounts page and reads its transactions.
+
+        Args:
+            account: The account's entry in FNB.accounts. Its transactions
+                are stored in account['transactions'].
+            mark: Optional. The account's high water mark from
+                DB.get_high_water_mark. Only transactions after it are kept.
+
+        Returns:
+            True if the accounts page was loaded again afterwards.
+        """
+        logger.info("Getting transactions for account: %s", account['name'])
+        # Open account
+        # Can't click account if link is off page so scroll to bottom and click again if it fails
+        try:
+            self.driver.find_element_by_id(account['nickname']).click()
+        except WebDriverException:
+            self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+            # Another try catch?
+            self.driver.find_element_by_id(account['nickname']).click()
+
+        with metrics.timer('fnb_account_seconds', account=account['name']):
+            self.wait_for_loader()
+            transactions = self.get_transactions(mark)
+        metrics.count('fnb_transactions_total', len(transactions or []), account=account['name'])
+        if transactions:
+            account['transactions'] = transactions
+            logger.info("Found %d transactions", len(account['transactions']))
+        elif len(transactions) == 0:
+            logger.info("No transactions found for account")
+        else:
+            logger.warning("Unable to get transactions!")
+        # Go back to accounts page before going to next account
+        return self.load_account_page()
+
+    def get_transactions_concurrently(self, sessions, marks=None):
+        """Reads the transactions of all accounts using this and other sessions at the same time.
+
+        Each session runs in its own thread and takes the next account still
+        to be read until none are left. Results are stored in this instance's
+        accounts.
+
+        Args:
+            sessions: A list of other FNB instances logged in to the same
+                profile.
+            marks: Optional. A dict of account number to high water mark.
+
+        Returns:
+            True if the transactions of every account were read.
+        """
+        marks = marks or {}
+        pending = queue.Queue()
+        for account in self.accounts:
+            pending.put(account)
+
+        def work(session):
+            if session is not self and not session.load_account_page():
+                return
+            while True:
+                try:
+                    account = pending.get_nowait()
+                except queue.Empty:
+                    return
+                if not session.get_account_transactions(self.accounts[account], marks.get(account)):
+                    return
+
+        workers = [self] + list(sessions)
+        logger.info("Getting transactions for %d accounts with %d sessions", len(self.accounts), len(workers))
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            list(executor.map(work, workers))
+        if not pending.empty():
+            logger.warning("Unable to get transactions for %d accounts", pending.qsize())
+            return False
+        return True
+
+    def get_transactions(self, mark=None):
         # Make sure we're on the Transaction History Tab
         header = self.driver.find_element_by_xpath('//*[@id="subTabsScrollable"]')
         tabs = header.find_elements_by_xpath('//*[contains(@class,"subTabText")]')
         if not (self.click_tab(tabs, 'transaction')):
             return False
 
-        transaction_table = self.driver.find_element_by_xpath("// *[ @ id = 'transactionHistoryTables_tableContent']")
+        self.driver.find_element_by_xpath("// *[ @ id = 'transactionHistoryTables_tableContent']")
 
         # Change to find all class contains tableGroup then loop through all tableGroup for class contains tableCell
         # Below should work for cheque account and savings
         # Doesn't work for credit card account but topline doesn't have a credit card so this might still work
         # Need to check layout of investment accounts
-        dates = [d.text for d in transaction_table.find_elements_by_xpath('//*[@id="counter"]')]
-        descriptions = [desc.text for desc in transaction_table.find_elements_by_xpath('//*[@id="shortDescription"]')]
-        references = [ref.text for ref in transaction_table.find_elements_by_xpath('//*[@id="reference"]')]
-        fees = [f.text for f in transaction_table.find_elements_by_xpath('//*[@id="serviceFee"]')]
-        amounts = [amt.text for amt in transaction_table.find_elements_by_xpath('//*[contains(@id,"amount")]')]
-        balances = [bal.text for bal in transaction_table.find_elements_by_xpath('//*[@id="ledgerBalance"]')]
+        columns = self.extract_columns(self.transaction_xpaths)
+        dates, descriptions, references, fees, amounts, balances = [[e[0] for e in col] for col in columns]
 
         if len(references) == 0:
             references = [''] * len(dates)
@@ -188,12 +437,35 @@ class FNB(Scraper):
             fees = [''] * len(dates)
 
         transactions = list(zip(dates, descriptions, references, fees, amounts, balances))
+        if mark:
+            # transactions are listed newest first. Stop at the last transaction already in the database
+            transactions = get_new_transactions(transactions, mark)
         return transactions
 
+    def extract_columns(self, xpaths, id_columns=()):
+        """Returns a list of [text, id] of the elements matching each xpath.
+
+        With script_extraction, all columns are read with one execute_script
+        call instead of a WebDriver request per element. Otherwise elements
+        are read one by one, and ids are only read for the columns in
+        id_columns. Other columns have an id of None.
+        """
+        if self.script_extraction:
+            try:
+                return self.driver.execute_script(self.extract_script, list(xpaths))
+            except WebDriverException as e:
+                logger.warning("Script extraction failed, reading elements one by one: %s", e)
+        return [[[e.text, e.get_attribute('id') if i in id_columns else None]
+                 for e in self.driver.find_elements_by_xpath(xpath)]
+                for i, xpath in enumerate(xpaths)]
+
     def wait_for_loader(self):
-        loader = self.driver.find_element_by_xpath('//*[@id="loaderOverlay"]')
-        while loader.get_attribute('data-visible').lower() == 'true':
-            pass
+        try:
+            self.waits.until(self.driver, attribute_is_not(self.loader, 'data-visible', 'true'), 'loader')
+        except TimeoutException:
+            logger.warning("Timeout waiting for page to load")
+            return False
+        return True
 
     def click_tab(self, tabs, tab_name):
         tab_names = [tab.text for tab in tabs]
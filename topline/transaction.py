@@ -1,5 +1,6 @@
 import re
 import logging
+from array import array
 from datetime import datetime
 from topline import MONTHS
 
@@ -33,9 +34,98 @@ def date_check(month1, year1, month2, year2):
     return month1, year1 + offset
 
 
+def get_type(account_name, username, description, amount):
+    # classify a transaction from the account it was made in, the matched user, its description and amount
+    account_name = account_name.lower()
+    if 'cheque' in account_name:
+        if username is not None and username != 'TIG':
+            return 'contribution'
+        if 'MONTHLY ACCOUNT FEE' in description.upper() or amount < 0:
+            return 'expense'
+        if amount > 0:
+            return 'income'
+        return 'unknown'
+    if 'savings' in account_name or 'deposit' in account_name:
+        if 'profit share' in description.lower():
+            return 'roi'
+        return 'unknown'
+    return None
+
+
+def get_period(ref, transaction_type, date, matcher):
+    # return the month and year a transaction is for
+    month_id = None
+    if transaction_type == 'unknown':
+        logger.info("Unknown transaction")
+        year = date.year % 2000
+    elif transaction_type == 'contribution':
+        # find month in transaction reference
+        month_ids = matcher.match_months(ref)
+        month_id = month_ids[0] if len(month_ids) == 1 else None
+        if not month_id:
+            month_id = ref[1] if type(ref[1]) is int and ref[1] < 13 else None
+        years = [r for i, r in enumerate(ref) if is_number(r)]
+        year = (years[0] if len(years) == 1 else date.year) % 2000
+    else:
+        year = date.year % 2000
+    year += 2000
+    if not month_id:
+        month_id = date.month
+
+    return date_check(month_id, year, date.month, date.year)
+
+
+def get_new_transactions(transactions, mark):
+    # return the transactions after a high water mark from DB.get_high_water_mark
+    # transactions are listed newest first, as read by FNB.get_transactions
+    if not mark:
+        return list(transactions)
+    last_date, last_rows = mark
+    new = []
+    for trans in transactions:
+        t = Transaction(trans, None)
+        if t.date < last_date:
+            break
+        if t.date > last_date or (t.description, t.reference, t.amount) not in last_rows:
+            new.append(trans)
+    return new
+
+
+class ReferenceMatcher:
+    """Maps reference tokens to users and months using dictionary lookups.
+
+    Built once from the usernames returned by DB.get_usernames() and MONTHS. Gives the same results as
+    comparing every token against every username and month name.
+
+    Attributes:
+        usernames: The list of (id, username, alt_username) tuples the matcher was built from.
+    """
+
+    def __init__(self, usernames, months=MONTHS):
+        self.usernames = usernames
+        self.users = {}
+        for ui, u in enumerate(usernames):
+            for name in set(u[1:]):
+                self.users.setdefault(name, []).append(ui)
+        self.months = {name: mi for mi, m in months.items() for name in m}
+        self.tig_id = next((u[0] for u in usernames if u[1] == "TIG"), None)
+
+    def match_user(self, ref):
+        """Returns the (user_id, username) found in the reference tokens, or TIG if not exactly one match."""
+        uid = [ui for r in ref for ui in self.users.get(r, ())]
+        if len(uid) != 1:
+            return self.tig_id, "TIG"
+        return self.usernames[uid[0]][0], self.usernames[uid[0]][1]
+
+    def match_months(self, ref):
+        """Returns a list of month ids found in the reference tokens."""
+        return [self.months[r] for r in ref if r in self.months]
+
+
 class Transaction:
     usernames = None
     accounts = None
+    matcher = None
 
     def __init__(self, transaction, account):
         self.account = account
@@ -54,21 +144,7 @@ class Transaction:
 
     def transaction_type(self):
         account_name = [acc[1] for acc in Transaction.accounts if acc[0] == self.account][0]
-        if 'cheque' in account_name.lower():
-            if self.username is not None and self.username != 'TIG':
-                self.type = 'contribution'
-            else:
-                if 'MONTHLY ACCOUNT FEE' in self.description.upper() or self.amount < 0:
-                    self.type = 'expense'
-                elif self.amount > 0:
-                    self.type = 'income'
-                else:
-                    self.type = 'unknown'
-        elif 'savings' in account_name.lower() or 'deposit' in account_name.lower():
-            if 'profit share' in self.description.lower():
-                self.type = 'roi'
-            else:
-                self.type = 'unknown'
+        self.type = get_type(account_name, self.username, self.description, self.amount)
 
         # if self.type == 'expense' or self.type == 'roi':
         #     self.username = "TIG"
@@ -79,42 +155,125 @@ class Transaction:
         ref = format_string(self.reference) or format_string(self.description)
         self.get_user(ref)
         self.transaction_type()
-
-        if self.type == 'unknown':
-            logger.info("Unknown transaction")
-            self.year = self.date.year % 2000
-        elif self.type == 'contribution':
-            # find month in transaction reference
-            month_ids = [mi for mi, m in MONTHS.items() for ri, r in enumerate(ref) if r in m]
-            self.month_id = month_ids[0] if len(month_ids) == 1 else None
-            if not self.month_id:
-                self.month_id = ref[1] if type(ref[1]) is int and ref[1] < 13 else None
-            years = [r for i, r in enumerate(ref) if is_number(r)]
-            self.year = (years[0] if len(years) == 1 else self.date.year) % 2000
-        else:
-            self.year = self.date.year % 2000
-        self.year += 2000
-        if not self.month_id:
-            self.month_id = self.date.month
-
-        self.month_id, self.year = date_check(self.month_id, self.year, self.date.month, self.date.year)
+        self.month_id, self.year = get_period(ref, self.type, self.date, self.get_matcher())
 
         if self.type == 'contribution':
             self.month = MONTHS[self.month_id][0].capitalize()
 
         return True
 
+    def row(self):
+        """Returns a tuple of values in the order of the transactions table, processing the transaction if needed."""
+        if self.year is None:
+            self.process_transaction()
+        return (self.account, self.date, self.description, self.reference, self.amount,
+                self.user_id, self.month, self.year)
+
+    @staticmethod
+    def get_matcher():
+        # rebuild the matcher if the usernames have been replaced
+        if Transaction.matcher is None or Transaction.matcher.usernames is not Transaction.usernames:
+            Transaction.matcher = ReferenceMatcher(Transaction.usernames)
+        return Transaction.matcher
+
     def get_user(self, ref):
         # determine user
         # usernames retrieved from database to account for alternatives. If match is found, index is determined from
         # internal user list to retain spreadsheet order
-        uid = [ui for ui, u in enumerate(Transaction.usernames) for ri, r in enumerate(ref) if r in u[1:]]
-        if len(uid) is not 1:
-            # logger.debug("Error finding user in reference: %s", self.reference)
-            # return False
-            self.username = "TIG"
-            self.user_id = [u[0] for u in Transaction.usernames if u[1] == "TIG"][0]
-        else:
-            self.user_id = Transaction.usernames[uid[0]][0]
-            self.username = Transaction.usernames[uid[0]][1]
+        self.user_id, self.username = self.get_matcher().match_user(ref)
         return True
+
+
+class TransactionBatch:
+    """Columnar batch of processed transactions.
+
+    Parses and classifies a batch of raw transactions in one pass over each
+    column. Dates, amounts, reference tokens and account names are parsed once
+    per distinct value, which suits historical imports where the same dates,
+    amounts and descriptions repeat thousands of times. Results are identical
+    to processing each row with Transaction.process_transaction.
+
+    Uses Transaction.usernames and Transaction.accounts, which must be set
+    before creating a batch.
+
+    Attributes:
+        account: array of account numbers.
+        date: list of datetime.date transaction dates.
+        description: list of upper case descriptions.
+        reference: list of upper case references.
+        amount: array of transaction amounts.
+        user_id: list of user ids.
+        month_id: array of contribution month numbers.
+        year: array of contribution years.
+        type: array of indices into TransactionBatch.TYPES.
+        transaction_id: list of database ids, None until added to the database.
+    """
+
+    TYPES = (None, 'contribution', 'expense', 'income', 'roi', 'unknown')
+
+    def __init__(self, transactions):
+        """Processes a batch of transactions.
+
+        Args:
+            transactions: An iterable of (transaction, account) pairs, where
+                transaction is a tuple as returned by FNB.get_transactions.
+                topline.importer.read_statement yields pairs in this format.
+        """
+        transactions = list(transactions)
+        transactions, accounts = zip(*transactions) if transactions else ((), ())
+        columns = list(zip(*transactions)) or [()] * 5
+        self.account = array('q', accounts)
+        self.date = self.parse(columns[0], lambda d: datetime.strptime(d, '%d %b %Y').date())
+        self.description = [d.upper() for d in columns[1]]
+        tokens = {}
+        references = self.parse(columns[2], lambda r: (r.upper(), format_string(r)))
+        self.reference = [r[0] if r[1] else '' for r in references]
+        self.amount = array('d', self.parse(columns[4], lambda a: float(a.replace(",", ""))))
+        self.user_id = []
+        self.month_id = array('b')
+        self.year = array('h')
+        self.type = array('b')
+        self.transaction_id = [None] * len(self.account)
+
+        matcher = Transaction.get_matcher()
+        account_names = dict(acc[:2] for acc in Transaction.accounts)
+        type_ids = {t: i for i, t in enumerate(self.TYPES)}
+        for i, (ref, desc) in enumerate(zip(references, self.description)):
+            if not ref[1]:
+                if desc not in tokens:
+                    tokens[desc] = format_string(desc)
+                ref = tokens[desc]
+            else:
+                ref = ref[1]
+            user_id, username = matcher.match_user(ref)
+            transaction_type = get_type(account_names[self.account[i]], username, desc, self.amount[i])
+            month_id, year = get_period(ref, transaction_type, self.date[i], matcher)
+            self.user_id.append(user_id)
+            self.month_id.append(month_id)
+            self.year.append(year)
+            self.type.append(type_ids[transaction_type])
+
+    def __len__(self):
+        return len(self.account)
+
+    @staticmethod
+    def parse(column, func):
+        # apply func once per distinct value in column
+        values = {v: func(v) for v in set(column)}
+        return [values[v] for v in column]
+
+    def get_type(self, i):
+        """Returns the transaction type of row i."""
+        return self.TYPES[self.type[i]]
+
+    def get_month(self, i):
+        """Returns the contribution month name of row i, None if not a contribution."""
+        if self.TYPES[self.type[i]] != 'contribution':
+            return None
+        return MONTHS[self.month_id[i]][0].capitalize()
+
+    def rows(self):
+        """Yields tuples of column values in the order of the transactions table."""
+        for i in range(len(self.account)):
+            yield (self.account[i], self.date[i], self.description[i], self.reference[i], self.amount[i],
+                   self.user_id[i], self.get_month(i), self.year[i])